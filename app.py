@@ -1,21 +1,25 @@
 import sys
 import os
-import io
+import atexit
 from functools import wraps
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file
-from flask import current_app, session, after_this_request
+from flask import current_app, session, after_this_request, Response, stream_with_context
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 from python_scripts.sql_models.models import db, User, FriendRequest, Group, GroupMember, Message
 from python_scripts.handlers.p2p_socket_handler import P2PSocketHandler
 from python_scripts.handlers.message_handler import MessageHandler
-from python_scripts.handlers.ipfs_handler import IPFSHandler
+from python_scripts.handlers.chat_log import ChatLog, ChatIndex
+from python_scripts.handlers.ipfs_handler import get_ipfs_handler, prime_stream
+from python_scripts.handlers.task_status_store import TaskStatusStore
 from python_scripts.dht.group_dht import GroupDHT
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from python_scripts.public_chat.bucket_manager import BucketManager
 from python_scripts.public_chat.chat_node import ChatNode
+from python_scripts.public_chat.chat_node_registry import ChatNodeRegistry
+from python_scripts.public_chat.flood_dedup import get_message_deduplicator
 import smtplib
 import random
 import mimetypes
@@ -39,14 +43,24 @@ import logging
 import tempfile
 import hashlib
 import time
+import shutil
+import threading
+import uuid
 from python_scripts.dht.group_dht import GroupDHT
 from concurrent.futures import ThreadPoolExecutor
 
-upload_executor = ThreadPoolExecutor(max_workers=5)
-upload_status = {}
+upload_executor = ThreadPoolExecutor(max_workers=Config.UPLOAD_WORKERS)
+upload_slots = threading.BoundedSemaphore(Config.UPLOAD_MAX_PENDING)
+migration_executor = ThreadPoolExecutor(max_workers=1)
+# Finished uploads stay queryable for UPLOAD_STATUS_TTL, then answer "expired"
+upload_status = TaskStatusStore(
+    default_ttl=Config.UPLOAD_STATUS_TTL,
+    tombstone_ttl=Config.UPLOAD_STATUS_TOMBSTONE_TTL,
+    db_path=Config.UPLOAD_STATUS_DB
+)
 active_group_dhts = {}
 active_users = {}
-chat_nodes = {}
+chat_nodes = ChatNodeRegistry()
 bucket_manager = BucketManager()
 
 load_dotenv()
@@ -64,8 +78,8 @@ socketio = SocketIO(app,
 
 mail = Mail(app)
 
-#IPFS Setup
-ipfs_handler = IPFSHandler()
+#IPFS Setup (shared, pooled client)
+ipfs_handler = get_ipfs_handler()
 
 # Add health check
 if not ipfs_handler.check_ipfs_health():
@@ -77,6 +91,20 @@ else:
 #Message Handler Setup
 message_handler = MessageHandler()
 
+# Segmented, append-only private chat histories, one log per conversation
+chat_log = ChatLog(ipfs_handler)
+chat_index = ChatIndex(ipfs_handler, chat_log)
+
+def flush_chat_nodes():
+    """Save coalesced public-chat bucket changes before the process exits"""
+    for node in list(chat_nodes.values()):
+        try:
+            node.secure_bucket.flush()
+        except Exception as e:
+            app.logger.error(f"Error flushing bucket for node {node.node_id}: {str(e)}")
+
+atexit.register(flush_chat_nodes)
+
 app.config['UPLOAD_FOLDER'] = Config.UPLOAD_FOLDER
 
 # Login Manager Setup
@@ -412,6 +440,8 @@ def login():
     if user and user.check_password(password):
         login_user(user)
         P2PSocketHandler.start_user_socket_server(user)
+        if user.chat_history_hash:
+            migration_executor.submit(migrate_chat_envelopes, user.id)
         return jsonify({"message": "Login successful!", "redirect": url_for('dashboard')}), 200
 
 @app.route('/logout')
@@ -593,6 +623,50 @@ def get_friend_socket_info(friend_id):
         'port': friend.socket_port
     })
 
+def parse_page_args(before, limit):
+    """Normalise before/limit cursor arguments from a request"""
+    before = int(before) if before not in (None, '') else None
+    limit = int(limit) if limit not in (None, '') else Config.CHAT_HISTORY_PAGE_SIZE
+    return before, max(1, min(limit, Config.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+def load_chat_index(user):
+    """Load a user's conversation index, upgrading older history formats once"""
+    index_hash = chat_index.upgrade(user.chat_history_hash, user.id)
+    if index_hash != user.chat_history_hash:
+        user.chat_history_hash = index_hash
+        db.session.commit()
+    return chat_index.load(index_hash)
+
+def migrate_chat_envelopes(user_id, max_attempts=3):
+    """Background job: rewrite a user's stored messages in the current envelope format"""
+    with app.app_context():
+        for _ in range(max_attempts):
+            try:
+                user = User.query.get(user_id)
+                if not user or not user.chat_history_hash:
+                    return
+                old_hash = user.chat_history_hash
+                index_hash = chat_index.upgrade(old_hash, user.id)
+                new_hash = chat_index.migrate_envelopes(
+                    index_hash, message_handler.upgrade_envelope, MessageHandler.ENVELOPE_VERSION
+                )
+                if new_hash == old_hash:
+                    return
+                # Only swap the pointer if no message was sent while we were rewriting
+                updated = User.query.filter_by(id=user_id, chat_history_hash=old_hash).update(
+                    {'chat_history_hash': new_hash}
+                )
+                db.session.commit()
+                if updated:
+                    app.logger.info(f"Migrated chat history envelopes for user {user_id}")
+                    return
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Error migrating chat history for user {user_id}: {str(e)}")
+                return
+            finally:
+                db.session.remove()
+
 @app.route('/api/chat_history/<int:friend_id>')
 @login_required
 def get_chat_history(friend_id):
@@ -603,55 +677,40 @@ def get_chat_history(friend_id):
             app.logger.error(f"Friend with ID {friend_id} not found")
             return jsonify({'messages': [], 'error': 'Friend not found'}), 404
 
+        try:
+            before, limit = parse_page_args(request.args.get('before'), request.args.get('limit'))
+        except ValueError:
+            return jsonify({'messages': [], 'error': 'Invalid pagination cursor'}), 400
+
         chat_history_hash = current_user.chat_history_hash
         app.logger.debug(f"Current user chat history hash: {chat_history_hash}")
         
         if not chat_history_hash:
             app.logger.debug("No chat history hash found")
-            return jsonify({'messages': []}), 200
+            return jsonify({'messages': [], 'next_cursor': None}), 200
 
         try:
-            # Get content from IPFS with detailed logging
-            app.logger.debug(f"Attempting to get content from IPFS with hash: {chat_history_hash}")
-            encrypted_history = ipfs_handler.get_content(chat_history_hash)
-            app.logger.debug(f"Retrieved encrypted history of length: {len(encrypted_history) if encrypted_history else 0}")
-            
-            if not encrypted_history:
-                app.logger.warning("No encrypted history retrieved from IPFS")
-                return jsonify({'messages': []}), 200
-
-            # Try to decode the JSON
+            # Only this conversation's log is read, and only the segments of the requested page
             try:
-                chat_history = json.loads(encrypted_history)
-                app.logger.debug(f"Successfully decoded JSON with {len(chat_history)} messages")
+                conversation_root = chat_index.conversation_root(load_chat_index(current_user), friend_id)
+                app.logger.debug(f"Reading chat log with manifest hash: {conversation_root}")
+                filtered_history, next_cursor = chat_log.read_page(conversation_root, before, limit)
             except json.JSONDecodeError as e:
                 app.logger.error(f"JSON decode error: {str(e)}")
-                app.logger.error(f"Raw content (first 200 chars): {encrypted_history[:200]}")
                 return jsonify({'messages': [], 'error': 'Invalid chat history format'}), 200
 
-            # Filter messages
-            filtered_history = [
-                msg for msg in chat_history 
-                if (msg['sender_id'] == current_user.id and msg['friend_id'] == friend_id) or 
-                   (msg['sender_id'] == friend_id and msg['friend_id'] == current_user.id)
-            ]
-            app.logger.debug(f"Filtered {len(filtered_history)} messages for friend {friend_id}")
+            app.logger.debug(f"Loaded {len(filtered_history)} messages for friend {friend_id}")
 
-            # Decrypt messages
+            # Decrypt messages as one parallel batch
+            decrypted_contents = message_handler.decrypt_many(msg['content'] for msg in filtered_history)
             decrypted_history = []
-            for msg in filtered_history:
-                try:
-                    decrypted_msg = msg.copy()
-                    decrypted_msg['content'] = message_handler.decrypt_message(msg['content'])
-                    decrypted_history.append(decrypted_msg)
-                except Exception as e:
-                    app.logger.error(f"Error decrypting message: {str(e)}")
-                    decrypted_msg = msg.copy()
-                    decrypted_msg['content'] = "Error: Could not decrypt message"
-                    decrypted_history.append(decrypted_msg)
+            for msg, content in zip(filtered_history, decrypted_contents):
+                decrypted_msg = msg.copy()
+                decrypted_msg['content'] = content if content is not None else "Error: Could not decrypt message"
+                decrypted_history.append(decrypted_msg)
 
             app.logger.debug(f"Successfully decrypted {len(decrypted_history)} messages")
-            return jsonify({'messages': decrypted_history}), 200
+            return jsonify({'messages': decrypted_history, 'next_cursor': next_cursor}), 200
 
         except Exception as e:
             app.logger.error(f"Error with IPFS operations: {str(e)}")
@@ -732,32 +791,30 @@ def send_message():
         if not ipfs_handler.check_ipfs_health():
             raise Exception("IPFS service is not available")
 
+        friend = User.query.get(friend_id)
+        new_message = {
+            'sender_id': current_user.id,
+            'friend_id': friend_id,
+            'content': message_handler.encrypt_message(message_content),
+            'timestamp': timestamp,
+            'cleared_by': []
+        }
+
         # Store message for both users regardless of active chat
-        for user in [current_user, User.query.get(friend_id)]:
-            chat_history = []
-            if user.chat_history_hash:
-                try:
-                    encrypted_history = ipfs_handler.get_content(user.chat_history_hash)
-                    chat_history = json.loads(encrypted_history)
-                except Exception as e:
-                    app.logger.error(f"Error loading chat history for user {user.id}: {str(e)}")
-                    chat_history = []
-
-            # Add new message to history
-            new_message = {
-                'sender_id': current_user.id,
-                'friend_id': friend_id,
-                'content': message_handler.encrypt_message(message_content),
-                'timestamp': timestamp,
-                'cleared_by': []
-            }
-            
-            chat_history.append(new_message)
-            
+        appended_roots = {}
+        for user, other_id in [(current_user, friend_id), (friend, current_user.id)]:
             try:
-                # Store updated history in IPFS with timeout
-                updated_history_hash = ipfs_handler.add_content(json.dumps(chat_history))
-                user.chat_history_hash = updated_history_hash
+                index = load_chat_index(user)
+                conversation_root = chat_index.conversation_root(index, other_id)
+
+                # Both users usually share one conversation log, so append it only once
+                if conversation_root not in appended_roots:
+                    # Only the tail segment and manifest are uploaded
+                    appended_roots[conversation_root] = chat_log.append(conversation_root, new_message)
+
+                user.chat_history_hash = chat_index.set_conversation_root(
+                    index, user.id, other_id, appended_roots[conversation_root]
+                )
             except Exception as e:
                 app.logger.error(f"Failed to store chat history in IPFS: {str(e)}")
                 raise Exception("Failed to store message")
@@ -788,29 +845,28 @@ def store_message():
     message = data.get('message')
     
     # Store message in IPFS
-    ipfs_handler = IPFSHandler()
     ipfs_hash = ipfs_handler.add_content(message)
     
     # Here you might want to store the IPFS hash in your database to keep track of the chat history
     
     return jsonify({'status': 'success', 'ipfs_hash': ipfs_hash})
 
+@app.route('/api/ipfs/cache_stats')
+@login_required
+def get_ipfs_cache_stats():
+    return jsonify(ipfs_handler.cache.stats())
+
+@app.route('/api/flood/dedup_stats')
+@login_required
+def get_flood_dedup_stats():
+    return jsonify(get_message_deduplicator().stats())
+
 @app.route('/api/clear_chat/<int:friend_id>', methods=['POST'])
 @login_required
 def clear_chat(friend_id):
     try:
-        # Get the current user's chat history
-        if current_user.chat_history_hash:
-            current_user_history = json.loads(ipfs_handler.get_content(current_user.chat_history_hash))
-        else:
-            current_user_history = []
-
-        # Remove messages with the specific friend
-        current_user_history = [msg for msg in current_user_history 
-                                if not (msg['friend_id'] == friend_id or msg['sender_id'] == friend_id)]
-
-        # Store the updated history back to IPFS
-        new_history_hash = ipfs_handler.add_content(json.dumps(current_user_history))
+        # Drop this friend's conversation from the current user's index only
+        new_history_hash = chat_index.remove_conversation(load_chat_index(current_user), friend_id)
 
         # Update the current user's chat history hash in the database
         current_user.chat_history_hash = new_history_hash
@@ -822,28 +878,64 @@ def clear_chat(friend_id):
         app.logger.error(f"Error clearing chat history: {str(e)}")
         return jsonify({"success": False, "error": "An error occurred while clearing chat history."}), 500
     
-def handle_file_upload(file_content, filename, user_id, task_id):
+def read_with_progress(file_path, on_progress, chunk_size=None):
+    """Yield a file in chunks, reporting the running byte count as it is consumed"""
+    chunk_size = chunk_size or Config.IPFS_STREAM_CHUNK_SIZE
+    bytes_done = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            bytes_done += len(chunk)
+            on_progress(bytes_done)
+            yield chunk
+
+def handle_file_upload(file_path, filename, user_id, task_id):
     try:
+        bytes_total = os.path.getsize(file_path)
+        last_percent = [-1]
+
+        def report_progress(bytes_done):
+            percent = int(bytes_done * 100 / bytes_total) if bytes_total else 100
+            # Only publish when the whole-number percentage moves
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                upload_status.set(task_id, {
+                    'status': 'processing',
+                    'owner_id': user_id,
+                    'filename': filename,
+                    'bytes_done': bytes_done,
+                    'bytes_total': bytes_total,
+                    'progress': percent
+                }, ttl=Config.UPLOAD_STATUS_ACTIVE_TTL)
+                socketio.emit('upload_progress', {
+                    'uploadId': task_id,
+                    'progress': percent,
+                    'bytes_done': bytes_done,
+                    'bytes_total': bytes_total
+                }, room=f"user_{user_id}")
+
         # Update status to processing
-        upload_status[task_id] = {'status': 'processing'}
+        report_progress(0)
         
-        # Encrypt the file content
-        encrypted_content = message_handler.encrypt_file(file_content)
-
-        # Upload to IPFS
-        ipfs_hash = ipfs_handler.add_content(encrypted_content)
+        # Encrypt frame by frame while streaming the spooled file to IPFS
+        ipfs_hash = ipfs_handler.add_stream(
+            lambda: message_handler.encrypt_file_stream(read_with_progress(file_path, report_progress))
+        )
         
         if not ipfs_hash:
             raise Exception("Failed to upload to IPFS")
 
         # Store the successful result
-        upload_status[task_id] = {
+        upload_status.set(task_id, {
             'status': 'completed',
             'ipfs_hash': ipfs_hash,
             'filename': filename,
             'owner_id': user_id,
+            'progress': 100,
             'file_link': f'/api/download_file/{ipfs_hash}/{filename}'
-        }
+        })
         
         # Emit success event
         socketio.emit('upload_complete', {
@@ -853,58 +945,67 @@ def handle_file_upload(file_content, filename, user_id, task_id):
 
     except Exception as e:
         app.logger.error(f"Error in file upload task: {str(e)}")
-        upload_status[task_id] = {
+        upload_status.set(task_id, {
             'status': 'error',
+            'owner_id': user_id,
             'error': str(e)
-        }
+        })
         socketio.emit('upload_error', {
-            'task_id': task_id,
+            'uploadId': task_id,
             'error': str(e)
         }, room=f"user_{user_id}")
-    
-    # Clean up status after 5 minutes
-    def cleanup_status():
-        time.sleep(300)  # 5 minutes
-        upload_status.pop(task_id, None)
-    
-    upload_executor.submit(cleanup_status)
+
+    finally:
+        upload_slots.release()
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
 
 @app.route('/api/share_file', methods=['POST'])
 @login_required
 def share_file():
-    try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': 'No file provided'})
-            
-        file = request.files['file']
-        if not file.filename:
-            return jsonify({'success': False, 'error': 'No file selected'})
-            
-        # Generate task ID
-        task_id = f"upload_{int(time.time())}_{current_user.id}"
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'No file provided'})
         
-        # Read file content
-        file_content = file.read()
+    file = request.files['file']
+    if not file.filename:
+        return jsonify({'success': False, 'error': 'No file selected'})
+
+    # Bound the number of queued and running uploads
+    if not upload_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'error': 'Too many uploads in progress, please try again shortly'}), 503
+
+    spool_path = None
+    try:
+        task_id = f"upload_{uuid.uuid4().hex}"
+        filename = secure_filename(file.filename)
         
-        # Encrypt and upload to IPFS
-        encrypted_content = message_handler.encrypt_file(file_content)
-        ipfs_hash = ipfs_handler.add_content(encrypted_content)
+        # Spool the request body to disk so the worker outlives the request
+        spool_fd, spool_path = tempfile.mkstemp(prefix='share_upload_')
+        with os.fdopen(spool_fd, 'wb') as spool:
+            shutil.copyfileobj(file.stream, spool, Config.IPFS_STREAM_CHUNK_SIZE)
         
-        if not ipfs_hash:
-            raise Exception("Failed to upload to IPFS")
-            
-        # Generate download link
-        file_link = f'/api/download_file/{ipfs_hash}/{secure_filename(file.filename)}'
+        upload_status.set(
+            task_id,
+            {'status': 'queued', 'owner_id': current_user.id, 'filename': filename, 'progress': 0},
+            ttl=Config.UPLOAD_STATUS_ACTIVE_TTL
+        )
+        upload_executor.submit(handle_file_upload, spool_path, filename, current_user.id, task_id)
         
         return jsonify({
             'success': True,
             'task_id': task_id,
-            'file_link': file_link,
-            'ipfs_hash': ipfs_hash,
-            'filename': secure_filename(file.filename)
-        })
+            'filename': filename
+        }), 202
         
     except Exception as e:
+        upload_slots.release()
+        if spool_path:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
         app.logger.error(f"Error sharing file: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
@@ -912,37 +1013,37 @@ def share_file():
 @login_required
 def get_upload_status(task_id):
     try:
-        status = upload_status.get(task_id, {'status': 'in_progress'})
+        status = upload_status.get(task_id)
+        if status is None or status.get('owner_id', current_user.id) != current_user.id:
+            return jsonify({'status': 'unknown', 'error': 'Unknown upload'}), 404
+        if status['status'] == 'expired':
+            return jsonify({'status': 'expired', 'error': 'Upload status has expired'}), 410
         return jsonify(status)
     except Exception as e:
         return jsonify({'status': 'error', 'error': str(e)})
 
+def streaming_download_response(chunks, filename):
+    """Build an attachment response that streams chunks to the client"""
+    response = Response(
+        stream_with_context(chunks),
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    
+    # Add headers to prevent caching
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+    return response
+
 @app.route('/api/download_file/<ipfs_hash>/<filename>', methods=['GET'])
 @login_required
 def download_file(ipfs_hash, filename):
     try:
-        # Get file content from IPFS
-        encrypted_content = ipfs_handler.get_content(ipfs_hash)
-        if not encrypted_content:
-            return jsonify({'success': False, 'error': 'File not found'}), 404
-            
-        # Decrypt the content
-        decrypted_content = message_handler.decrypt_file(encrypted_content)
+        # Decrypt frame by frame as the ciphertext streams in from IPFS
+        chunks = prime_stream(message_handler.decrypt_file_stream(ipfs_handler.cat_stream(ipfs_hash)))
         
-        # Create response with proper headers
-        response = send_file(
-            io.BytesIO(decrypted_content),
-            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
-            as_attachment=True,
-            download_name=filename  # This ensures proper filename with extension
-        )
-        
-        # Add headers to prevent caching
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        
-        return response
+        return streaming_download_response(chunks, filename)
         
     except Exception as e:
         app.logger.error(f"Download error: {str(e)}")
@@ -953,7 +1054,9 @@ def download_file(ipfs_hash, filename):
 def sign_chat(friend_id):
     try:
         chat_id = f"{current_user.id}_{friend_id}"
-        chat_history = json.loads(ipfs_handler.get_content(current_user.chat_history_hash))
+        chat_history = chat_log.read_all(
+            chat_index.conversation_root(load_chat_index(current_user), friend_id)
+        )
         chat_hash = hashlib.sha256(json.dumps(chat_history).encode()).hexdigest()
         # Instead of blockchain signature, use a simple hash
         signature = hashlib.sha256(f"{chat_hash}_{current_user.id}".encode()).hexdigest()
@@ -968,7 +1071,9 @@ def verify_chat(friend_id):
     try:
         data = request.json
         chat_id = f"{current_user.id}_{friend_id}"
-        chat_history = json.loads(ipfs_handler.get_content(current_user.chat_history_hash))
+        chat_history = chat_log.read_all(
+            chat_index.conversation_root(load_chat_index(current_user), friend_id)
+        )
         chat_hash = hashlib.sha256(json.dumps(chat_history).encode()).hexdigest()
         # Verify using the same simple hash method
         expected_signature = hashlib.sha256(f"{chat_hash}_{current_user.id}".encode()).hexdigest()
@@ -1486,20 +1591,15 @@ def handle_join_chat():
             emit('error', {'message': 'Please create a bucket first'})
             return
             
-        # Create chat node if doesn't exist
-        if user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
-            
-            # Get existing bucket hash and sync
-            existing_hash = bucket_manager.get_bucket_hash(user_id)
-            if existing_hash:
-                chat_nodes[user_id].sync_with_peer(existing_hash)
+        # Create chat node if doesn't exist; its bucket loads in the background
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
+        node.secure_bucket.prefetch()
         
         # Join chat room
         join_room('p2p_chat')
         
-        # Get current bucket hash
-        current_hash = chat_nodes[user_id].get_bucket_hash()
+        # Get current (published) bucket hash without waiting for the bucket to load
+        current_hash = bucket_manager.get_bucket_hash(user_id)
         
         # Broadcast join message
         emit('user_joined', {
@@ -1508,15 +1608,22 @@ def handle_join_chat():
             'bucket_hash': current_hash
         }, room='p2p_chat')
         
-        # Send chat history to user
-        emit('chat_history', {
-            'messages': chat_nodes[user_id].get_chat_history()
-        })
+        # Send chat history to user once the bucket has loaded
+        socketio.start_background_task(send_public_chat_history, node, request.sid)
         
     except Exception as e:
         app.logger.error(f"Error in join_chat: {str(e)}")
         emit('error', {'message': str(e)})
 
+def send_public_chat_history(node, sid):
+    """Background task: emit a node's public chat history to one client"""
+    try:
+        socketio.emit('chat_history', {
+            'messages': node.get_chat_history()
+        }, room=sid)
+    except Exception as e:
+        app.logger.error(f"Error sending chat history: {str(e)}")
+
 @socketio.on('send_message')
 def handle_message(data):
     try:
@@ -1531,12 +1638,9 @@ def handle_message(data):
         if not node:
             return
             
-        # Broadcast message
+        # Broadcast message (the bucket save is coalesced and published in the background)
         result = node.broadcast_message(content)
         
-        # Update bucket hash in manager
-        bucket_manager.update_bucket_hash(user_id, result['bucket_hash'])
-        
         # Send to all peers
         emit('new_message', {
             'message': result['message'],
@@ -1559,10 +1663,9 @@ def handle_check_bucket():
         
         print(f"Bucket status - has_bucket: {has_bucket}, hash: {bucket_hash}")
         
-        # Create chat node if bucket exists but node doesn't
+        # Create chat node if bucket exists but node doesn't, and start loading it
         if has_bucket and user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
-            chat_nodes[user_id].sync_with_peer(bucket_hash)
+            chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username)).secure_bucket.prefetch()
         
         emit('bucket_status', {
             'has_bucket': has_bucket,
@@ -1579,14 +1682,10 @@ def handle_create_bucket():
         print(f"Creating bucket for user {user_id}")
         
         # Create new chat node if it doesn't exist
-        if user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
         
-        # Get bucket hash
-        bucket_hash = chat_nodes[user_id].get_bucket_hash()
-        
-        # Update bucket manager
-        bucket_manager.update_bucket_hash(user_id, bucket_hash)
+        # Get bucket hash (saving flushes and publishes it to the bucket manager)
+        bucket_hash = node.get_bucket_hash()
         
         print(f"Bucket created with hash: {bucket_hash}")
         
@@ -1602,7 +1701,8 @@ def handle_create_bucket():
 def handle_sync_request(data):
     try:
         peer_bucket_hash = data.get('bucket_hash')
-        if not peer_bucket_hash:
+        peer_id = data.get('user_id')
+        if not peer_bucket_hash and peer_id is None:
             return
             
         user_id = str(current_user.id)
@@ -1612,11 +1712,15 @@ def handle_sync_request(data):
         if not node:
             return
             
-        # Sync with peer's bucket
-        new_hash = node.sync_with_peer(peer_bucket_hash)
-        
-        # Update bucket hash in manager
-        bucket_manager.update_bucket_hash(user_id, new_hash)
+        peer_node = chat_nodes.get(str(peer_id)) if peer_id is not None else None
+        if peer_node is not None and peer_node is not node:
+            # Peer is hosted here: exchange version vectors and copy only the missing messages
+            new_hash = node.apply_delta(peer_node.delta_since(node.get_version_vector()), durable=True)
+        elif peer_bucket_hash:
+            # Sync with peer's bucket, saving now so the new hash can be announced
+            new_hash = node.sync_with_peer(peer_bucket_hash, durable=True, peer_id=peer_id)
+        else:
+            return
         
         # Broadcast new bucket hash
         emit('bucket_updated', {
@@ -1711,6 +1815,8 @@ def handle_message(data):
 def handle_connect(auth=None):
     if current_user.is_authenticated:
         join_room('p2p_chat')
+        # Per-user room for upload progress and other direct notifications
+        join_room(f"user_{current_user.id}")
         if current_user.id not in active_users:
             active_users[current_user.id] = set()
         active_users[current_user.id].add(request.sid)
@@ -1755,12 +1861,25 @@ def handle_get_message_history(data):
     community_id = data.get('community_id')
     if not community_id:
         return
-        
-    messages = Message.query.filter_by(community_id=community_id)\
-        .order_by(Message.timestamp.asc())\
-        .all()
+
+    try:
+        before, limit = parse_page_args(data.get('before'), data.get('limit'))
+    except ValueError:
+        emit('error', {'message': 'Invalid pagination cursor'})
+        return
+
+    # Newest page first by id, one extra row tells us whether older messages exist
+    query = Message.query.filter_by(community_id=community_id)
+    if before is not None:
+        query = query.filter(Message.id < before)
+    messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+
+    has_more = len(messages) > limit
+    messages = list(reversed(messages[:limit]))
+    next_cursor = messages[0].id if has_more and messages else None
         
     message_history = [{
+        'id': msg.id,
         'username': msg.username,
         'content': msg.content,
         'message': msg.content,
@@ -1771,7 +1890,9 @@ def handle_get_message_history(data):
     
     emit('message_history', {
         'community_id': community_id,
-        'messages': message_history
+        'messages': message_history,
+        'before': before,
+        'next_cursor': next_cursor
     })
 
 @socketio.on('join_community')
@@ -1796,13 +1917,10 @@ def handle_get_my_files():
         print(f"Getting files for user {user_id}")
         
         # Create chat node if it doesn't exist
-        if user_id not in chat_nodes:
-            bucket_hash = bucket_manager.get_bucket_hash(user_id)
-            if bucket_hash:
-                chat_nodes[user_id] = ChatNode(user_id, current_user.username)
-                chat_nodes[user_id].secure_bucket.sync_with_peer(bucket_hash)
-        
         node = chat_nodes.get(user_id)
+        if not node and bucket_manager.get_bucket_hash(user_id):
+            node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
+        
         if not node:
             emit('error', {'message': 'Chat node not found'})
             return
@@ -1843,33 +1961,14 @@ def download_shared_file(file_id, filename):
     try:
         # Get user's chat node
         user_id = str(current_user.id)
-        if user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
             
-        # Get file content from secure bucket
-        file_content = chat_nodes[user_id].secure_bucket.get_file_content(file_id)
-        if not file_content:
+        # Stream file content from secure bucket
+        file_chunks = node.secure_bucket.stream_file_content(file_id)
+        if file_chunks is None:
             return jsonify({'error': 'File not found'}), 404
             
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(file_content)
-            temp_path = temp_file.name
-            
-        @after_this_request
-        def cleanup(response):
-            try:
-                os.unlink(temp_path)
-            except Exception as e:
-                app.logger.error(f"Error cleaning up temp file: {e}")
-            return response
-            
-        return send_file(
-            temp_path,
-            as_attachment=True,
-            download_name=filename,
-            max_age=0
-        )
+        return streaming_download_response(file_chunks, filename)
         
     except Exception as e:
         app.logger.error(f"Error downloading file: {str(e)}")
@@ -1892,8 +1991,7 @@ def handle_store_message(data):
         user_id = str(current_user.id)
         
         # Get or create chat node
-        if user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
         
         # Create message structure
         message = {
@@ -1904,9 +2002,8 @@ def handle_store_message(data):
             'timestamp': timestamp
         }
         
-        # Store message and get updated bucket hash
-        result = chat_nodes[user_id].broadcast_message(content)
-        bucket_manager.update_bucket_hash(user_id, result['bucket_hash'])
+        # Store message; the bucket save is coalesced and published in the background
+        node.broadcast_message(content)
         
         # Emit new message to all clients in p2p_chat room
         emit('new_message', message, broadcast=True, room='p2p_chat')
@@ -1922,10 +2019,7 @@ def handle_clear_chat():
         user_id = str(current_user.id)
         
         # Get user's chat node
-        node = chat_nodes.get(user_id)
-        if not node:
-            node = ChatNode(user_id, current_user.username)
-            chat_nodes[user_id] = node
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
             
         # Check if there's any history to clear
         current_history = node.get_chat_history()
@@ -1936,12 +2030,9 @@ def handle_clear_chat():
             })
             return
             
-        # Clear chat history in bucket
+        # Clear chat history in bucket (saved and published immediately)
         result = node.clear_chat_history()
         
-        # Update bucket hash
-        bucket_manager.update_bucket_hash(user_id, result['bucket_hash'])
-        
         emit('chat_history_cleared', {
             'success': True,
             'bucket_hash': result['bucket_hash']
@@ -2038,10 +2129,7 @@ def handle_clear_all_requests():
 def handle_get_chat_history():
     try:
         user_id = str(current_user.id)
-        node = chat_nodes.get(user_id)
-        if not node:
-            node = ChatNode(user_id, current_user.username)
-            chat_nodes[user_id] = node
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
             
         chat_history = node.get_chat_history()
         emit('chat_history', {'messages': chat_history})
@@ -2061,10 +2149,19 @@ def get_peer_files():
     try:
         users_data = {}
         print(f"Getting peer files. Current user: {current_user.username}")
-        print(f"Available buckets: {bucket_manager.buckets_data.keys()}")
+        # ?since=<timestamp> lists only buckets updated after that time. as_of is
+        # read first: anything indexed after it is stamped later, so the next
+        # ?since=as_of call sees it
+        as_of = bucket_manager.last_update_time()
+        since = request.args.get('since', type=float)
+        if since is not None:
+            buckets = bucket_manager.buckets_updated_since(since)
+        else:
+            buckets = bucket_manager.all_buckets()
+        print(f"Available buckets: {buckets.keys()}")
         
         # Get all users with buckets
-        for user_id, bucket_info in bucket_manager.buckets_data.items():
+        for user_id, bucket_info in buckets.items():
             if user_id != str(current_user.id):  # Exclude current user
                 # Get username from database
                 user = User.query.get(int(user_id))
@@ -2077,8 +2174,8 @@ def get_peer_files():
                     }
                     
                     # Get files if user has a chat node
-                    if user_id in chat_nodes:
-                        node = chat_nodes[user_id]
+                    node = chat_nodes.get(user_id)
+                    if node:
                         files = node.secure_bucket.get_files()
                         print(f"Found {len(files)} files for user {user.username}")
                         users_data[user_id]['files'] = files
@@ -2087,7 +2184,8 @@ def get_peer_files():
         
         return jsonify({
             'success': True,
-            'users': users_data
+            'users': users_data,
+            'as_of': as_of
         })
     except Exception as e:
         print(f"Error in get_peer_files: {e}")
@@ -2098,10 +2196,9 @@ def get_peer_files():
 def download_peer_file(user_id, file_id, filename):
     try:
         # Get the peer's chat node
-        if user_id not in chat_nodes:
+        node = chat_nodes.get(user_id)
+        if not node:
             return jsonify({'error': 'Peer not found'}), 404
-            
-        node = chat_nodes[user_id]
         
         # Get file content from peer's secure bucket
         file_content = node.secure_bucket.get_file_content(file_id)
@@ -2145,8 +2242,9 @@ def handle_p2p_search(data):
         ipfs_results = []
         
         # P2P flood search
-        if hasattr(chat_nodes[str(current_user.id)], 'p2p_network'):
-            chat_nodes[str(current_user.id)].p2p_network.flood_search(filename)
+        node = chat_nodes[str(current_user.id)]
+        if hasattr(node, 'p2p_network'):
+            node.p2p_network.flood_search(filename)
             
         # Combine results
         all_results = p2p_results + ipfs_results
@@ -2163,12 +2261,17 @@ def handle_p2p_file_request(data):
         filename = data.get('filename')
         source = data.get('source')
         
-        # Request file from peer
-        if hasattr(chat_nodes[str(current_user.id)], 'p2p_network'):
-            chat_nodes[str(current_user.id)].p2p_network.request_file(
-                filename, 
-                source
-            )
+        # Request file from peer, or in pieces from every peer that has it
+        node = chat_nodes[str(current_user.id)]
+        if hasattr(node, 'p2p_network'):
+            p2p_network = node.p2p_network
+            if len(p2p_network.file_sources.get(filename, [])) > 1:
+                p2p_network.swarm_download(filename)
+            else:
+                p2p_network.request_file(
+                    filename, 
+                    source
+                )
             
     except Exception as e:
         print(f"Error requesting P2P file: {e}")
@@ -2236,16 +2339,17 @@ def handle_file_search(data):
             
         # Use P2P flooding for search
         user_id = str(current_user.id)
-        if user_id in chat_nodes and hasattr(chat_nodes[user_id], 'p2p_network'):
+        node = chat_nodes.get(user_id)
+        if node and hasattr(node, 'p2p_network'):
             # Initiate flood search
-            chat_nodes[user_id].p2p_network.flood_search(query)
+            node.p2p_network.flood_search(query)
             
             # Wait briefly for responses to come in
             time.sleep(2)  # Adjust timeout as needed
             
             # Get collected results from the P2P network
             results = []
-            for filename, sources in chat_nodes[user_id].p2p_network.file_sources.items():
+            for filename, sources in node.p2p_network.search_results().items():
                 for host, port, file_id in sources:
                     results.append({
                         'name': filename,
@@ -2289,10 +2393,7 @@ def delete_file(file_id):
 def download_peer_file_alternate(user_id, file_id, filename):
     try:
         # Get the peer's chat node
-        if user_id not in chat_nodes:
-            chat_nodes[user_id] = ChatNode(user_id, current_user.username)
-            
-        node = chat_nodes[user_id]
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
         
         # Get file content from peer's secure bucket
         file_content = node.secure_bucket.get_file_content(file_id)
@@ -2336,11 +2437,16 @@ def handle_file_download(data):
             
         # Request file from peer using P2P network
         user_id = str(current_user.id)
-        if user_id in chat_nodes and hasattr(chat_nodes[user_id], 'p2p_network'):
-            chat_nodes[user_id].p2p_network.request_file(
-                filename,
-                (source['host'], source['port'], source['file_id'])
-            )
+        node = chat_nodes.get(user_id)
+        if node and hasattr(node, 'p2p_network'):
+            p2p_network = node.p2p_network
+            if len(p2p_network.file_sources.get(filename, [])) > 1:
+                p2p_network.swarm_download(filename)
+            else:
+                p2p_network.request_file(
+                    filename,
+                    (source['host'], source['port'], source['file_id'])
+                )
             
             # The P2P network will handle receiving the file and emitting the download_ready event
             
@@ -2353,10 +2459,11 @@ def handle_file_download(data):
 def download_temp_file(filename):
     try:
         user_id = str(current_user.id)
-        if user_id not in chat_nodes:
+        node = chat_nodes.get(user_id)
+        if not node:
             return jsonify({'error': 'Node not found'}), 404
             
-        temp_dir = chat_nodes[user_id].p2p_network.temp_directory
+        temp_dir = node.p2p_network.temp_directory
         return send_from_directory(temp_dir, filename, as_attachment=True)
         
     except Exception as e:
@@ -2552,17 +2659,11 @@ def handle_public_chat_message(data):
         user_id = str(current_user.id)
         
         # Get user's chat node
-        node = chat_nodes.get(user_id)
-        if not node:
-            node = ChatNode(user_id, current_user.username)
-            chat_nodes[user_id] = node
+        node = chat_nodes.get_or_create(user_id, lambda: ChatNode(user_id, current_user.username))
             
-        # Create and broadcast message
+        # Create and broadcast message (the bucket save is coalesced and published in the background)
         result = node.broadcast_message(content)
         
-        # Update bucket hash in manager
-        bucket_manager.update_bucket_hash(user_id, result['bucket_hash'])
-        
         # Send to all peers
         emit('new_message', {
             'message': {
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from urllib.parse import quote
 from dotenv import load_dotenv
 
@@ -55,3 +56,116 @@ class Config:
     IPFS_API_PORT = 5001
     IPFS_GATEWAY_PORT = 8080
     IPFS_TIMEOUT = 30  # Increased timeout for network operations
+
+    # IPFS connection pool (per worker process) and per-operation timeouts
+    IPFS_POOL_CONNECTIONS = int(os.getenv('IPFS_POOL_CONNECTIONS', 4))
+    IPFS_POOL_SIZE = int(os.getenv('IPFS_POOL_SIZE', 16))
+    IPFS_CONNECT_TIMEOUT = 5
+    IPFS_ADD_TIMEOUT = IPFS_TIMEOUT
+    IPFS_CAT_TIMEOUT = IPFS_TIMEOUT
+    IPFS_HEALTH_TIMEOUT = 5
+
+    # Streaming transfers: chunk size for IPFS add/cat
+    IPFS_STREAM_CHUNK_SIZE = 256 * 1024
+
+    # Content-addressed IPFS cache: in-memory LRU that spills to disk
+    IPFS_CACHE_MEMORY_BYTES = int(os.getenv('IPFS_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+    IPFS_CACHE_DISK_BYTES = int(os.getenv('IPFS_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+    IPFS_CACHE_DIR = os.getenv('IPFS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dsn_ipfs_cache'))
+
+    # Private chat histories are stored as append-only logs of fixed-size segments
+    CHAT_LOG_SEGMENT_SIZE = 100
+
+    # History pagination: default "latest N" page and the largest page a client may request
+    CHAT_HISTORY_PAGE_SIZE = 50
+    CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+    # Batch decryption of chat histories
+    DECRYPT_WORKERS = min(8, os.cpu_count() or 4)
+    DECRYPT_PARALLEL_THRESHOLD = 64
+
+    # Chunked file encryption: plaintext bytes per authenticated frame, and the
+    # largest frame size accepted from a file header when decrypting
+    FILE_FRAME_SIZE = 64 * 1024
+    FILE_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    # Background /api/share_file uploads: worker count, the most uploads that may
+    # be queued or running at once, and how long a finished status is kept
+    UPLOAD_WORKERS = 5
+    UPLOAD_MAX_PENDING = 20
+    UPLOAD_STATUS_TTL = 300
+
+    # Upload status store: in-flight statuses expire if a worker stops reporting,
+    # "expired" answers are kept this long, and the SQLite file that lets them
+    # survive restarts (set UPLOAD_STATUS_DB to an empty string for memory only)
+    UPLOAD_STATUS_ACTIVE_TTL = 3600
+    UPLOAD_STATUS_TOMBSTONE_TTL = 24 * 3600
+    UPLOAD_STATUS_DB = os.getenv('UPLOAD_STATUS_DB', 'data/upload_status.db')
+
+    # Public-chat bucket saves are coalesced: one save per window (seconds), or
+    # sooner once this many changes are pending
+    BUCKET_FLUSH_WINDOW = float(os.getenv('BUCKET_FLUSH_WINDOW', 2.0))
+    BUCKET_FLUSH_MAX_PENDING = int(os.getenv('BUCKET_FLUSH_MAX_PENDING', 20))
+    # Threads that run due bucket saves (one scheduler thread times them all)
+    BUCKET_FLUSH_WORKERS = 4
+
+    # Threads that fetch public-chat bucket sections from IPFS in parallel
+    BUCKET_LOAD_WORKERS = 8
+
+    # Public chat: messages kept per bucket, clock skew tolerated by the per-peer
+    # sync watermark (seconds), and how many merged peer bucket hashes to remember
+    PUBLIC_CHAT_HISTORY_LIMIT = 100
+    CHAT_SYNC_WATERMARK_SKEW = 5
+    CHAT_SYNC_HASH_MEMORY = 256
+
+    # Registry of each user's public-chat bucket hashes (SQLite; the legacy
+    # data/user_buckets.json is imported on first start)
+    BUCKET_DB_PATH = os.getenv('BUCKET_DB_PATH', 'data/user_buckets.db')
+    # Lock stripes in the in-memory bucket registry index
+    BUCKET_INDEX_SHARDS = 16
+
+    # Public-chat ChatNodes kept in memory: at most this many, and any node
+    # unused for CHAT_NODE_IDLE_TIMEOUT seconds is shut down by a reaper that
+    # runs every CHAT_NODE_REAP_INTERVAL seconds
+    CHAT_NODE_MAX = int(os.getenv('CHAT_NODE_MAX', 200))
+    CHAT_NODE_IDLE_TIMEOUT = int(os.getenv('CHAT_NODE_IDLE_TIMEOUT', 1800))
+    CHAT_NODE_REAP_INTERVAL = 60
+
+    # Flood network transport: one selector loop per process, handlers run on
+    # this many pool threads; bytes read per recv and outgoing connect timeout
+    FLOOD_HANDLER_WORKERS = 16
+    FLOOD_RECV_SIZE = 64 * 1024
+    FLOOD_CONNECT_TIMEOUT = 10
+    # Received bytes queued per peer before the loop stops reading from it
+    # (resumes once handlers have worked through half of them)
+    FLOOD_INBOX_LIMIT = 4 * 1024 * 1024
+    # Flood wire protocol: 'json' or 'msgpack' (used only if msgpack is
+    # installed; peers decode either), and the largest frame accepted
+    FLOOD_WIRE_ENCODING = os.getenv('FLOOD_WIRE_ENCODING', 'json')
+    FLOOD_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    # Peer file transfers: bytes per binary chunk, most bytes buffered for one
+    # slow peer before the sender waits (up to FLOOD_SEND_TIMEOUT seconds),
+    # and how often a corrupt chunk is re-requested before giving up
+    FLOOD_FILE_CHUNK_SIZE = 256 * 1024
+    FLOOD_SEND_BUFFER_LIMIT = 4 * 1024 * 1024
+    FLOOD_SEND_TIMEOUT = 60
+    FLOOD_TRANSFER_RETRIES = 3
+    # Threads that serve file and manifest requests, kept apart from the
+    # handler pool so slow transfers can't stall message handling
+    FLOOD_TRANSFER_WORKERS = 8
+
+    # Swarm downloads from several flood-search sources: piece size, seconds
+    # without progress before a piece is reassigned, failures before a peer
+    # is dropped, and how many piece-hash manifests a sender caches
+    SWARM_PIECE_SIZE = 1024 * 1024
+    SWARM_STALL_TIMEOUT = 15
+    SWARM_MAX_PEER_FAILURES = 3
+    SWARM_MANIFEST_CACHE = 64
+
+    # Flood message de-duplication (shared per process): ids are remembered
+    # for up to FLOOD_DEDUP_TTL seconds in FLOOD_DEDUP_BUCKETS rotating sets,
+    # and never more than FLOOD_DEDUP_MAX_ENTRIES at once
+    FLOOD_DEDUP_TTL = int(os.getenv('FLOOD_DEDUP_TTL', 300))
+    FLOOD_DEDUP_BUCKETS = 6
+    FLOOD_DEDUP_MAX_ENTRIES = int(os.getenv('FLOOD_DEDUP_MAX_ENTRIES', 100000))
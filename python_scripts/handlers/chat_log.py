@@ -0,0 +1,216 @@
+import json
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from config import Config
+
+class ChatLog:
+    """Append-only chat log stored in IPFS as fixed-size segments plus a small head manifest.
+
+    Segment i holds messages [i * segment_size, (i + 1) * segment_size); the last
+    segment is the only one that is ever rewritten. The manifest hash is what gets
+    stored in User.chat_history_hash.
+    """
+
+    def __init__(self, ipfs_handler, segment_size: Optional[int] = None):
+        self.ipfs_handler = ipfs_handler
+        self.segment_size = segment_size or Config.CHAT_LOG_SEGMENT_SIZE
+
+    def _empty_manifest(self) -> Dict:
+        return {
+            'type': 'chat_log',
+            'version': 1,
+            'segment_size': self.segment_size,
+            'count': 0,
+            'segments': []
+        }
+
+    def _load_json(self, ipfs_hash: str):
+        return json.loads(self.ipfs_handler.get_content(ipfs_hash))
+
+    def load_manifest(self, root_hash: Optional[str]) -> Dict:
+        """Load the head manifest; legacy flat histories are converted in memory"""
+        if not root_hash:
+            return self._empty_manifest()
+
+        data = self._load_json(root_hash)
+        if isinstance(data, list):
+            # Legacy format: one JSON array holding the whole history
+            manifest = self._empty_manifest()
+            manifest['legacy_messages'] = data
+            manifest['count'] = len(data)
+            return manifest
+        return data
+
+    def append(self, root_hash: Optional[str], message: Dict) -> str:
+        """Append one message and return the new manifest hash"""
+        manifest = self.load_manifest(root_hash)
+
+        if 'legacy_messages' in manifest:
+            # Migrate on first write; later appends only touch the tail
+            return self.write(manifest['legacy_messages'] + [message])
+
+        segment_size = manifest['segment_size']
+        if manifest['count'] % segment_size == 0:
+            tail = [message]
+            manifest['segments'].append(None)
+        else:
+            tail = self._load_json(manifest['segments'][-1])
+            tail.append(message)
+
+        manifest['segments'][-1] = self.ipfs_handler.add_content(json.dumps(tail))
+        manifest['count'] += 1
+        return self.ipfs_handler.add_content(json.dumps(manifest))
+
+    def write(self, messages: List[Dict]) -> str:
+        """Write a complete log from scratch and return its manifest hash"""
+        manifest = self._empty_manifest()
+        for start in range(0, len(messages), self.segment_size):
+            segment = messages[start:start + self.segment_size]
+            manifest['segments'].append(self.ipfs_handler.add_content(json.dumps(segment)))
+        manifest['count'] = len(messages)
+        return self.ipfs_handler.add_content(json.dumps(manifest))
+
+    def iter_segments_backwards(self, root_hash: Optional[str]) -> Iterator[List[Dict]]:
+        """Yield segments newest first, fetching each one only when it is needed"""
+        manifest = self.load_manifest(root_hash)
+        if 'legacy_messages' in manifest:
+            yield manifest['legacy_messages']
+            return
+        for segment_hash in reversed(manifest['segments']):
+            yield self._load_json(segment_hash)
+
+    def read_all(self, root_hash: Optional[str]) -> List[Dict]:
+        """Return every message in the log, oldest first"""
+        segments = list(self.iter_segments_backwards(root_hash))
+        return [message for segment in reversed(segments) for message in segment]
+
+    def read_page(self, root_hash: Optional[str], before: Optional[int], limit: int) -> Tuple[List[Dict], Optional[int]]:
+        """Return up to limit messages ending just before cursor `before` (latest page when None).
+
+        Cursors are message positions in the log, so only the segments that
+        overlap the requested page are fetched. The second value is the cursor
+        for the next older page, or None when the start of the log is reached.
+        """
+        manifest = self.load_manifest(root_hash)
+        end = manifest['count'] if before is None else max(0, min(before, manifest['count']))
+        start = max(0, end - limit)
+
+        if 'legacy_messages' in manifest:
+            messages = manifest['legacy_messages'][start:end]
+        else:
+            segment_size = manifest['segment_size']
+            messages = []
+            if end > start:
+                for index in range(start // segment_size, (end - 1) // segment_size + 1):
+                    segment = self._load_json(manifest['segments'][index])
+                    offset = index * segment_size
+                    messages.extend(segment[max(0, start - offset):end - offset])
+
+        return messages, (start if start > 0 else None)
+
+
+class ChatIndex:
+    """Per-user index mapping friend_id to the root of that conversation's ChatLog.
+
+    Conversations are keyed by the (min_id, max_id) pair of the two users, so
+    opening one chat only touches that conversation's segments. The index hash
+    is what gets stored in User.chat_history_hash.
+    """
+
+    def __init__(self, ipfs_handler, chat_log: ChatLog):
+        self.ipfs_handler = ipfs_handler
+        self.chat_log = chat_log
+
+    @staticmethod
+    def conversation_key(user_id, friend_id) -> str:
+        low, high = sorted((int(user_id), int(friend_id)))
+        return f"{low}_{high}"
+
+    def _empty_index(self) -> Dict:
+        return {
+            'type': 'chat_index',
+            'version': 1,
+            'conversations': {}
+        }
+
+    def load(self, index_hash: Optional[str]) -> Dict:
+        """Load an index in the current format (see upgrade for older histories)"""
+        if not index_hash:
+            return self._empty_index()
+        data = json.loads(self.ipfs_handler.get_content(index_hash))
+        if isinstance(data, dict) and data.get('type') == 'chat_index':
+            return data
+        raise ValueError("Chat history has not been upgraded to a conversation index")
+
+    def save(self, index: Dict) -> str:
+        return self.ipfs_handler.add_content(json.dumps(index))
+
+    def upgrade(self, index_hash: Optional[str], user_id) -> Optional[str]:
+        """Return a hash in index format, partitioning a flat history or single log if needed"""
+        if not index_hash:
+            return index_hash
+        data = json.loads(self.ipfs_handler.get_content(index_hash))
+        if isinstance(data, dict) and data.get('type') == 'chat_index':
+            return index_hash
+
+        messages = self.chat_log.read_all(index_hash)
+        conversations = {}
+        for message in messages:
+            if str(message['sender_id']) == str(user_id):
+                other_id = message['friend_id']
+            else:
+                other_id = message['sender_id']
+            conversations.setdefault(str(other_id), []).append(message)
+
+        index = self._empty_index()
+        for friend_id, conversation in conversations.items():
+            index['conversations'][friend_id] = {
+                'key': self.conversation_key(user_id, friend_id),
+                'root': self.chat_log.write(conversation)
+            }
+        return self.save(index)
+
+    def conversation_root(self, index: Dict, friend_id) -> Optional[str]:
+        entry = index['conversations'].get(str(friend_id))
+        return entry['root'] if entry else None
+
+    def set_conversation_root(self, index: Dict, user_id, friend_id, root_hash: str) -> str:
+        """Point friend_id at a new log root and return the new index hash"""
+        index['conversations'][str(friend_id)] = {
+            'key': self.conversation_key(user_id, friend_id),
+            'root': root_hash
+        }
+        return self.save(index)
+
+    def remove_conversation(self, index: Dict, friend_id) -> str:
+        index['conversations'].pop(str(friend_id), None)
+        return self.save(index)
+
+    def migrate_envelopes(self, index_hash: Optional[str], upgrade_content: Callable[[str], str],
+                          envelope_version: int) -> Optional[str]:
+        """Rewrite every conversation with upgrade_content applied to message contents.
+
+        The index records envelope_version afterwards so the migration runs once.
+        upgrade_content must be deterministic: both participants of a shared log
+        then produce identical segments and converge on the same root again.
+        """
+        if not index_hash:
+            return index_hash
+        index = self.load(index_hash)
+        if index.get('envelope_version', 1) >= envelope_version:
+            return index_hash
+
+        for entry in index['conversations'].values():
+            messages = self.chat_log.read_all(entry['root'])
+            upgraded = []
+            changed = False
+            for message in messages:
+                content = upgrade_content(message['content'])
+                if content != message['content']:
+                    message = dict(message, content=content)
+                    changed = True
+                upgraded.append(message)
+            if changed:
+                entry['root'] = self.chat_log.write(upgraded)
+
+        index['envelope_version'] = envelope_version
+        return self.save(index)
@@ -0,0 +1,169 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Only plain CIDs are cached; they are immutable and safe to use as file names
+_CID_PATTERN = re.compile(r'^[A-Za-z0-9]+$')
+
+class IPFSContentCache:
+    """Byte-budgeted two-tier LRU cache (memory, then disk spill) keyed by CID.
+
+    The lock only guards the bookkeeping; spill files are read and written
+    outside it, and a spilled entry is published once its file is complete.
+    """
+
+    def __init__(self, memory_budget: int, disk_budget: int, spill_directory: Optional[str]):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget if spill_directory else 0
+        self.spill_directory = spill_directory
+
+        self._memory = OrderedDict()  # cid -> bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # cid -> size on disk
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+        if self.spill_directory:
+            self._load_spill_directory()
+
+    def _load_spill_directory(self):
+        """Adopt blobs spilled by a previous run, oldest first"""
+        try:
+            os.makedirs(self.spill_directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.spill_directory):
+                path = os.path.join(self.spill_directory, name)
+                if _CID_PATTERN.match(name) and os.path.isfile(path):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, name, stat.st_size))
+            for _, cid, size in sorted(entries):
+                self._disk[cid] = size
+                self._disk_bytes += size
+            self._evict_disk()
+        except Exception as e:
+            print(f"Error loading IPFS cache spill directory: {e}")
+
+    def _spill_path(self, cid: str) -> str:
+        return os.path.join(self.spill_directory, cid)
+
+    def get(self, cid: str) -> Optional[bytes]:
+        """Return cached content for cid, or None on a miss"""
+        with self._lock:
+            data = self._memory.get(cid)
+            if data is not None:
+                self._memory.move_to_end(cid)
+                self.memory_hits += 1
+                return data
+            if cid not in self._disk:
+                self.misses += 1
+                return None
+
+        try:
+            with open(self._spill_path(cid), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._drop_disk_entry(cid)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            if cid in self._disk:
+                self._disk.move_to_end(cid)
+            self.disk_hits += 1
+            spills = self._put_memory(cid, data)
+        self._write_spills(spills)
+        return data
+
+    def put(self, cid: str, data: bytes):
+        """Cache content for cid; CIDs are immutable so entries never go stale"""
+        if not cid or not _CID_PATTERN.match(cid) or data is None:
+            return
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            if cid in self._memory:
+                self._memory.move_to_end(cid)
+                return
+            if len(data) > self.memory_budget:
+                spills = [(cid, data)]
+            else:
+                spills = self._put_memory(cid, data)
+        self._write_spills(spills)
+
+    def _put_memory(self, cid: str, data: bytes) -> List[Tuple[str, bytes]]:
+        """Add to the memory tier; returns the entries it pushed out, for _write_spills"""
+        if cid in self._memory or len(data) > self.memory_budget:
+            return []
+        self._memory[cid] = data
+        self._memory_bytes += len(data)
+        evicted = []
+        while self._memory_bytes > self.memory_budget:
+            old_cid, old_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_data)
+            self.memory_evictions += 1
+            evicted.append((old_cid, old_data))
+        return evicted
+
+    def _write_spills(self, entries: List[Tuple[str, bytes]]):
+        """Move entries to the disk tier if they fit its budget (called without the lock)"""
+        for cid, data in entries:
+            with self._lock:
+                if cid in self._disk or len(data) > self.disk_budget:
+                    continue
+            path = self._spill_path(cid)
+            # Unique temp name: two threads may spill the same CID at once
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"Error spilling {cid} to IPFS cache directory: {e}")
+                continue
+            with self._lock:
+                if cid not in self._disk:
+                    self._disk[cid] = len(data)
+                    self._disk_bytes += len(data)
+                    self._evict_disk()
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_budget and self._disk:
+            old_cid = next(iter(self._disk))
+            self._drop_disk_entry(old_cid)
+            self.disk_evictions += 1
+
+    def _drop_disk_entry(self, cid: str):
+        size = self._disk.pop(cid, 0)
+        self._disk_bytes -= size
+        try:
+            os.remove(self._spill_path(cid))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict:
+        """Hit, miss and eviction counters plus current tier usage"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_evictions': self.memory_evictions,
+                'disk_evictions': self.disk_evictions,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'memory_budget': self.memory_budget,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'disk_budget': self.disk_budget
+            }
@@ -1,15 +1,63 @@
 import requests
+from requests.adapters import HTTPAdapter
+import itertools
+import threading
+import uuid
 import time
 import json
 from config import Config
+from python_scripts.handlers.ipfs_cache import IPFSContentCache
 
 class IPFSHandler:
+    # One pooled HTTP session per process, shared by every handler instance
+    _session = None
+    _cache = None
+    _session_lock = threading.Lock()
+
     def __init__(self):
         self.ipfs_api_url = f'http://{Config.IPFS_API_HOST}:{Config.IPFS_API_PORT}/api/v0'
         self.timeout = Config.IPFS_TIMEOUT
         self.max_retries = 3
+        self.session = self._get_session()
+        self.cache = self._get_cache()
         print(f"Initialized IPFS Handler with URL: {self.ipfs_api_url}")
 
+    @classmethod
+    def _get_session(cls):
+        """Create the shared keep-alive session on first use"""
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                # Never wait for a pooled connection: long-lived cat_stream
+                # downloads can hold all of them, so extra requests open a
+                # short-lived connection instead of blocking with no timeout
+                adapter = HTTPAdapter(
+                    pool_connections=Config.IPFS_POOL_CONNECTIONS,
+                    pool_maxsize=Config.IPFS_POOL_SIZE,
+                    pool_block=False
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.verify = False
+                cls._session = session
+            return cls._session
+
+    @classmethod
+    def _get_cache(cls):
+        """Create the shared content-addressed cache on first use"""
+        with cls._session_lock:
+            if cls._cache is None:
+                cls._cache = IPFSContentCache(
+                    memory_budget=Config.IPFS_CACHE_MEMORY_BYTES,
+                    disk_budget=Config.IPFS_CACHE_DISK_BYTES,
+                    spill_directory=Config.IPFS_CACHE_DIR
+                )
+            return cls._cache
+
+    def _timeout(self, read_timeout):
+        """Build a (connect, read) timeout tuple for a single operation"""
+        return (Config.IPFS_CONNECT_TIMEOUT, read_timeout)
+
     def add_content(self, content):
         for attempt in range(self.max_retries):
             try:
@@ -22,20 +70,20 @@ class IPFSHandler:
                 print(f"URL: {self.ipfs_api_url}/add")
                 print(f"Content length: {len(content)}")
                 
-                response = requests.post(
+                response = self.session.post(
                     f'{self.ipfs_api_url}/add',
                     files=files,
                     params={'stream-channels': 'true'},  # Add this parameter
-                    timeout=self.timeout,
-                    verify=False
+                    timeout=self._timeout(Config.IPFS_ADD_TIMEOUT)
                 )
                 
                 print(f"Response status: {response.status_code}")
-                print(f"Response headers: {response.headers}")
                 print(f"Response content: {response.text[:200]}")
                 
                 if response.status_code == 200:
                     result = json.loads(response.text)
+                    # We already hold the bytes behind this CID, so seed the cache
+                    self.cache.put(result['Hash'], content)
                     return result['Hash']
                     
             except Exception as e:
@@ -47,14 +95,18 @@ class IPFSHandler:
         raise Exception(f"Failed to add content to IPFS after {self.max_retries} attempts")
 
     def get_content(self, ipfs_hash):
+        # CIDs are immutable, so a cached copy is always valid
+        cached = self.cache.get(ipfs_hash)
+        if cached is not None:
+            return cached
         try:
-            response = requests.post(  # Changed to POST
+            response = self.session.post(  # Changed to POST
                 f'{self.ipfs_api_url}/cat',
                 params={'arg': ipfs_hash},  # Use params instead of URL
-                timeout=self.timeout,
-                verify=False
+                timeout=self._timeout(Config.IPFS_CAT_TIMEOUT)
             )
             if response.status_code == 200:
+                self.cache.put(ipfs_hash, response.content)
                 return response.content
             else:
                 raise Exception(f"Failed to get content from IPFS. Status code: {response.status_code}")
@@ -62,10 +114,88 @@ class IPFSHandler:
             print(f"Error getting content from IPFS: {str(e)}")
             raise
 
+    def _multipart_body(self, source, boundary, chunk_size):
+        """Yield a multipart/form-data body for source without buffering it"""
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="file.txt"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        if hasattr(source, 'read'):
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in source:
+                if chunk:
+                    yield chunk
+        yield f'\r\n--{boundary}--\r\n'.encode()
+
+    def add_stream(self, source, chunk_size=None):
+        """Add a file object or an iterable of bytes to IPFS using a chunked upload.
+
+        source may also be a zero-argument callable returning a fresh iterable,
+        which lets generated bodies (e.g. encrypted streams) be retried.
+        """
+        chunk_size = chunk_size or Config.IPFS_STREAM_CHUNK_SIZE
+        # Only seekable file objects and body factories can be replayed on a retry
+        start = source.tell() if hasattr(source, 'seek') else None
+        replayable = start is not None or callable(source)
+        attempts = self.max_retries if replayable else 1
+
+        for attempt in range(attempts):
+            try:
+                if attempt > 0 and start is not None:
+                    source.seek(start)
+                body = source() if callable(source) else source
+                boundary = uuid.uuid4().hex
+                response = self.session.post(
+                    f'{self.ipfs_api_url}/add',
+                    data=self._multipart_body(body, boundary, chunk_size),
+                    headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                    params={'stream-channels': 'true'},
+                    timeout=self._timeout(Config.IPFS_ADD_TIMEOUT)
+                )
+                if response.status_code == 200:
+                    # Kubo may report progress lines first; the last line carries the hash
+                    result = json.loads(response.text.strip().splitlines()[-1])
+                    return result['Hash']
+                print(f"Streaming add failed with status {response.status_code}: {response.text[:200]}")
+            except Exception as e:
+                print(f"Error on streaming add attempt {attempt + 1}: {str(e)}")
+
+            if attempt < attempts - 1:
+                time.sleep(2 ** attempt)
+
+        raise Exception(f"Failed to stream content to IPFS after {attempts} attempts")
+
+    def cat_stream(self, ipfs_hash, chunk_size=None):
+        """Yield the content of ipfs_hash in chunks as it arrives from the daemon"""
+        chunk_size = chunk_size or Config.IPFS_STREAM_CHUNK_SIZE
+        response = self.session.post(
+            f'{self.ipfs_api_url}/cat',
+            params={'arg': ipfs_hash},
+            timeout=self._timeout(Config.IPFS_CAT_TIMEOUT),
+            stream=True
+        )
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Failed to get content from IPFS. Status code: {response.status_code}")
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+
     def connect_to_ipfs(self):
         for attempt in range(self.max_retries):
             try:
-                response = self.session.post(f"{self.ipfs_api_url}/version")
+                response = self.session.post(
+                    f"{self.ipfs_api_url}/version",
+                    timeout=self._timeout(Config.IPFS_HEALTH_TIMEOUT)
+                )
                 response.raise_for_status()
                 print("Successfully connected to IPFS")
                 return
@@ -86,10 +216,9 @@ class IPFSHandler:
     def check_ipfs_health(self):
         try:
             print(f"Checking IPFS health at {self.ipfs_api_url}/version")
-            response = requests.post(  # IPFS API typically uses POST
+            response = self.session.post(  # IPFS API typically uses POST
                 f'{self.ipfs_api_url}/version',
-                timeout=5,
-                verify=False
+                timeout=self._timeout(Config.IPFS_HEALTH_TIMEOUT)
             )
             print(f"Response status: {response.status_code}")
             print(f"Response content: {response.text[:200]}")
@@ -106,3 +235,24 @@ class IPFSHandler:
             return False
 
     # Add more methods as needed for your IPFS operations
+
+
+_shared_handler = None
+_shared_handler_lock = threading.Lock()
+
+def get_ipfs_handler() -> IPFSHandler:
+    """Return the process-wide IPFSHandler shared by the app, buckets and chat nodes"""
+    global _shared_handler
+    with _shared_handler_lock:
+        if _shared_handler is None:
+            _shared_handler = IPFSHandler()
+        return _shared_handler
+
+def prime_stream(chunks):
+    """Pull the first chunk now so fetch or decryption errors surface before a response starts"""
+    chunks = iter(chunks)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], chunks)
@@ -1,10 +1,65 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import base64
+import os
+import struct
 from config import Config
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional
+
+_decrypt_executor = None
+_decrypt_executor_lock = threading.Lock()
+
+def _get_decrypt_executor() -> ThreadPoolExecutor:
+    """Shared pool used for batch decryption"""
+    global _decrypt_executor
+    with _decrypt_executor_lock:
+        if _decrypt_executor is None:
+            _decrypt_executor = ThreadPoolExecutor(
+                max_workers=Config.DECRYPT_WORKERS,
+                thread_name_prefix='decrypt'
+            )
+        return _decrypt_executor
+
+# Chunked file format (v1):
+#   header: MAGIC | version (1 byte) | frame size (4 bytes) | salt (16 bytes)
+#   frames: length (4 bytes, top bit set on the final frame) | AES-GCM ciphertext
+# Each file gets its own key, HKDF(ENCRYPTION_KEY, salt). Frame nonces are the
+# frame counter plus a final-frame flag, so reordered, dropped or truncated
+# frames fail authentication.
+FILE_STREAM_MAGIC = b'DSNF'
+FILE_STREAM_VERSION = 1
+_FILE_HEADER = struct.Struct('>4sBI16s')
+_FRAME_LENGTH = struct.Struct('>I')
+_FINAL_FRAME_FLAG = 0x80000000
+_GCM_TAG_SIZE = 16
+
+def _iter_source(source, chunk_size: int) -> Iterator[bytes]:
+    """Yield bytes from a file object or an iterable of byte chunks"""
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+def _frame_nonce(counter: int, final: bool) -> bytes:
+    return counter.to_bytes(11, 'big') + (b'\x01' if final else b'\x00')
 
 class MessageHandler:
+    # Envelope v2 stores the raw Fernet token (already URL-safe base64) behind a
+    # version prefix; legacy v1 messages are base64(token) with no prefix.
+    ENVELOPE_VERSION = 2
+    ENVELOPE_PREFIX = 'v2:'
     def __init__(self, key=None):
         self.key = Config.ENCRYPTION_KEY
         if not isinstance(self.key, bytes):
@@ -19,26 +74,171 @@ class MessageHandler:
         }
         message_json = json.dumps(message_struct)
         encrypted = self.fernet.encrypt(message_json.encode())
-        return base64.b64encode(encrypted).decode()  # Convert to base64 string
+        return self.ENVELOPE_PREFIX + encrypted.decode()
     
+    def _envelope_token(self, encrypted_message):
+        """Return the raw Fernet token from a v2 or legacy envelope"""
+        if encrypted_message.startswith(self.ENVELOPE_PREFIX):
+            return encrypted_message[len(self.ENVELOPE_PREFIX):].encode()
+        return base64.b64decode(encrypted_message.encode())
+
+    def is_legacy_envelope(self, encrypted_message):
+        return isinstance(encrypted_message, str) and not encrypted_message.startswith(self.ENVELOPE_PREFIX)
+
+    def upgrade_envelope(self, encrypted_message):
+        """Rewrite a legacy envelope as v2 without decrypting it"""
+        if not self.is_legacy_envelope(encrypted_message):
+            return encrypted_message
+        try:
+            token = base64.b64decode(encrypted_message.encode(), validate=True)
+            # Every Fernet token starts with version byte 0x80, i.e. "gAAAAA" once encoded
+            if not token.startswith(b'gAAAAA'):
+                return encrypted_message
+            return self.ENVELOPE_PREFIX + token.decode()
+        except Exception as e:
+            print(f"Error upgrading message envelope: {e}")
+            return encrypted_message
+
     def decrypt_message(self, encrypted_message):
         try:
-            decoded = base64.b64decode(encrypted_message.encode())
+            decoded = self._envelope_token(encrypted_message)
             decrypted_json = self.fernet.decrypt(decoded).decode()
             return json.loads(decrypted_json)
         except Exception as e:
             print(f"Error decrypting message: {e}")
             return None
     
+    def decrypt_many(self, encrypted_messages: Iterable, decoder: Optional[Callable] = None) -> List:
+        """Decrypt a batch of messages on the shared pool.
+
+        Results keep the input order; an item that fails to decrypt comes back
+        as None, matching decrypt_message.
+        """
+        decoder = decoder or self.decrypt_message
+        items = list(encrypted_messages)
+
+        def decode_slice(batch):
+            results = []
+            for item in batch:
+                try:
+                    results.append(decoder(item))
+                except Exception as e:
+                    print(f"Error decrypting message: {e}")
+                    results.append(None)
+            return results
+
+        if len(items) < Config.DECRYPT_PARALLEL_THRESHOLD:
+            return decode_slice(items)
+
+        # One slice per worker keeps task overhead low for large histories
+        slice_size = -(-len(items) // Config.DECRYPT_WORKERS)
+        slices = [items[i:i + slice_size] for i in range(0, len(items), slice_size)]
+        results = []
+        for decoded in _get_decrypt_executor().map(decode_slice, slices):
+            results.extend(decoded)
+        return results
+    
     def encrypt_file(self, file_content):
-        encrypted_data = self.fernet.encrypt(file_content)
+        encrypted_data = b''.join(self.encrypt_file_stream([file_content]))
         if len(encrypted_data) > Config.MAX_IPFS_LENGTH:
             raise Exception(f"Encrypted file is too large. Maximum length is {Config.MAX_IPFS_LENGTH} bytes.")
         return encrypted_data
     
     def decrypt_file(self, encrypted_data):
-        decrypted_data = self.fernet.decrypt(encrypted_data)
-        return decrypted_data
+        return b''.join(self.decrypt_file_stream([encrypted_data]))
+
+    def _file_key(self, salt: bytes) -> AESGCM:
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'dsn-file-stream-v1')
+        return AESGCM(hkdf.derive(self.key))
+
+    def encrypt_file_stream(self, source, frame_size: Optional[int] = None) -> Iterator[bytes]:
+        """Encrypt a file object or byte-chunk iterable into the chunked format, one frame at a time"""
+        frame_size = frame_size or Config.FILE_FRAME_SIZE
+        salt = os.urandom(16)
+        header = _FILE_HEADER.pack(FILE_STREAM_MAGIC, FILE_STREAM_VERSION, frame_size, salt)
+        aesgcm = self._file_key(salt)
+        yield header
+
+        buffer = bytearray()
+        pending = None  # hold one full frame back so the last one can be flagged final
+        counter = 0
+        for chunk in _iter_source(source, frame_size):
+            buffer.extend(chunk)
+            while len(buffer) >= frame_size:
+                if pending is not None:
+                    yield self._seal_frame(aesgcm, header, counter, pending, final=False)
+                    counter += 1
+                pending = bytes(buffer[:frame_size])
+                del buffer[:frame_size]
+
+        if pending is not None and buffer:
+            yield self._seal_frame(aesgcm, header, counter, pending, final=False)
+            counter += 1
+            pending = None
+        last = bytes(buffer) if pending is None else pending
+        yield self._seal_frame(aesgcm, header, counter, last, final=True)
+
+    def _seal_frame(self, aesgcm, header, counter, plaintext, final):
+        ciphertext = aesgcm.encrypt(_frame_nonce(counter, final), plaintext, header)
+        length = len(ciphertext) | (_FINAL_FRAME_FLAG if final else 0)
+        return _FRAME_LENGTH.pack(length) + ciphertext
+
+    def decrypt_file_stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Decrypt chunked-format (or legacy Fernet) ciphertext as it arrives.
+
+        Raises on a tampered, reordered or truncated stream; plaintext is only
+        yielded for frames that authenticated.
+        """
+        chunks = iter(chunks)
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer.extend(chunk)
+            if len(buffer) >= _FILE_HEADER.size:
+                break
+
+        if bytes(buffer[:len(FILE_STREAM_MAGIC)]) != FILE_STREAM_MAGIC:
+            # Legacy files are a single Fernet token and can only be decrypted whole
+            for chunk in chunks:
+                buffer.extend(chunk)
+            yield self.fernet.decrypt(bytes(buffer))
+            return
+
+        header = bytes(buffer[:_FILE_HEADER.size])
+        _, version, frame_size, salt = _FILE_HEADER.unpack(header)
+        if version != FILE_STREAM_VERSION or frame_size > Config.FILE_MAX_FRAME_SIZE:
+            raise ValueError("Unsupported encrypted file format")
+        del buffer[:_FILE_HEADER.size]
+        aesgcm = self._file_key(salt)
+
+        counter = 0
+        chunks_done = False
+        while True:
+            if len(buffer) >= _FRAME_LENGTH.size:
+                length, = _FRAME_LENGTH.unpack_from(buffer)
+                final = bool(length & _FINAL_FRAME_FLAG)
+                length &= ~_FINAL_FRAME_FLAG
+                if length > frame_size + _GCM_TAG_SIZE:
+                    raise ValueError("Encrypted file frame is too large")
+                end = _FRAME_LENGTH.size + length
+                if len(buffer) >= end:
+                    ciphertext = bytes(buffer[_FRAME_LENGTH.size:end])
+                    del buffer[:end]
+                    plaintext = aesgcm.decrypt(_frame_nonce(counter, final), ciphertext, header)
+                    counter += 1
+                    if plaintext:
+                        yield plaintext
+                    if final:
+                        if buffer or next(chunks, None):
+                            raise ValueError("Unexpected data after final frame")
+                        return
+                    continue
+            if chunks_done:
+                raise ValueError("Encrypted file is truncated")
+            chunk = next(chunks, None)
+            if chunk is None:
+                chunks_done = True
+            else:
+                buffer.extend(chunk)
     
     def get_key(self):
         return self.key.decode()
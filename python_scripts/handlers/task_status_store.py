@@ -0,0 +1,179 @@
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# Statuses a task only holds while a worker is running it
+IN_PROGRESS_STATES = ('queued', 'processing')
+
+class TaskStatusStore:
+    """Background task status with TTL eviction and optional SQLite persistence.
+
+    Every status carries an expiry. One scheduler thread sleeps until the
+    earliest expiry in a heap, then replaces the status with an "expired"
+    tombstone, which is itself dropped after tombstone_ttl. Heap entries made
+    stale by a later set() are skipped when they come due. Only status
+    transitions reach the database; progress updates within a state stay in
+    memory, and writes happen outside the store lock.
+    """
+
+    def __init__(self, default_ttl: float, tombstone_ttl: float, db_path: Optional[str] = None):
+        self.default_ttl = default_ttl
+        self.tombstone_ttl = tombstone_ttl
+        self._entries = {}  # task_id -> (status, expires_at, is_tombstone)
+        self._heap = []  # (expires_at, task_id)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._dirty = {}  # task_id -> row to write, or None to delete
+
+        if db_path:
+            self._open_db(db_path)
+
+        self._scheduler = threading.Thread(target=self._run_scheduler, name='task-status-expiry', daemon=True)
+        self._scheduler.start()
+
+    def _open_db(self, db_path: str):
+        """Open the backing database and reload statuses that survived a restart"""
+        try:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS task_status ('
+                'task_id TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                'expires_at REAL NOT NULL, tombstone INTEGER NOT NULL DEFAULT 0)'
+            )
+            now = time.time()
+            self._db.execute('DELETE FROM task_status WHERE tombstone = 1 AND expires_at <= ?', (now,))
+            self._db.commit()
+            rows = self._db.execute('SELECT task_id, status, expires_at, tombstone FROM task_status').fetchall()
+            for task_id, status, expires_at, tombstone in rows:
+                status = json.loads(status)
+                if not tombstone and status.get('status') in IN_PROGRESS_STATES:
+                    # The worker died with the old process; don't report it as still running
+                    status = self._interrupted_status(status)
+                    expires_at = now + self.default_ttl
+                    self._db.execute(
+                        'UPDATE task_status SET status = ?, expires_at = ? WHERE task_id = ?',
+                        (json.dumps(status), expires_at, task_id)
+                    )
+                self._entries[task_id] = (status, expires_at, bool(tombstone))
+                heapq.heappush(self._heap, (expires_at, task_id))
+            self._db.commit()
+        except Exception as e:
+            print(f"Error opening task status database {db_path}: {e}")
+            self._db = None
+
+    def _interrupted_status(self, status: Dict) -> Dict:
+        interrupted = {'status': 'error', 'error': 'Interrupted by restart'}
+        for key in ('owner_id', 'filename'):
+            if key in status:
+                interrupted[key] = status[key]
+        return interrupted
+
+    def _mark_dirty(self, task_id: str):
+        """Queue task_id's current entry for the next _flush (caller holds the lock)"""
+        if self._db is None:
+            return
+        entry = self._entries.get(task_id)
+        if entry is None:
+            self._dirty[task_id] = None
+        else:
+            status, expires_at, tombstone = entry
+            self._dirty[task_id] = (json.dumps(status), expires_at, int(tombstone))
+
+    def _flush(self):
+        """Write queued changes to the database without holding the store lock"""
+        if self._db is None:
+            return
+        with self._db_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            try:
+                for task_id, row in dirty.items():
+                    if row is None:
+                        self._db.execute('DELETE FROM task_status WHERE task_id = ?', (task_id,))
+                    else:
+                        self._db.execute(
+                            'INSERT OR REPLACE INTO task_status (task_id, status, expires_at, tombstone) '
+                            'VALUES (?, ?, ?, ?)',
+                            (task_id,) + row
+                        )
+                self._db.commit()
+            except Exception as e:
+                print(f"Error persisting task statuses: {e}")
+
+    def _schedule(self, task_id: str, expires_at: float):
+        heapq.heappush(self._heap, (expires_at, task_id))
+        # Only wake the scheduler if this is now the earliest deadline
+        if self._heap[0][1] == task_id:
+            self._wakeup.notify()
+
+    def set(self, task_id: str, status: Dict, ttl: Optional[float] = None):
+        """Store status for task_id; it expires ttl seconds from now"""
+        expires_at = time.time() + (ttl if ttl is not None else self.default_ttl)
+        with self._lock:
+            previous = self._entries.get(task_id)
+            self._entries[task_id] = (dict(status), expires_at, False)
+            # Progress within an in-progress state is not worth a disk write;
+            # a restart turns such tasks into errors anyway
+            persist = (previous is None or previous[2]
+                       or previous[0].get('status') != status.get('status')
+                       or status.get('status') not in IN_PROGRESS_STATES)
+            if persist:
+                self._mark_dirty(task_id)
+            self._schedule(task_id, expires_at)
+        if persist:
+            self._flush()
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """Return the task's status, an "expired" tombstone, or None if never seen"""
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None:
+                return None
+            status, expires_at, tombstone = entry
+            if not tombstone and expires_at <= time.time():
+                # The scheduler has not caught up yet; answer as it would
+                return self._tombstone_status(status)
+            return dict(status)
+
+    def _tombstone_status(self, status: Dict) -> Dict:
+        tombstone = {'status': 'expired'}
+        if 'owner_id' in status:
+            tombstone['owner_id'] = status['owner_id']
+        return tombstone
+
+    def _expire_due(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, task_id = heapq.heappop(self._heap)
+            entry = self._entries.get(task_id)
+            if entry is None or entry[1] != expires_at:
+                continue  # superseded by a later set()
+            status, _, tombstone = entry
+            if tombstone:
+                del self._entries[task_id]
+            else:
+                tombstone_expires = now + self.tombstone_ttl
+                self._entries[task_id] = (self._tombstone_status(status), tombstone_expires, True)
+                heapq.heappush(self._heap, (tombstone_expires, task_id))
+            self._mark_dirty(task_id)
+
+    def _run_scheduler(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._expire_due(now)
+                if not self._dirty:
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._wakeup.wait(timeout)
+                    continue
+            self._flush()
@@ -0,0 +1,128 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from config import Config
+
+class _FlushScheduler:
+    """Process-wide timer for deferred bucket saves.
+
+    One thread sleeps until the earliest due save and hands it to a small
+    pool, so the thread count stays constant however many buckets are dirty.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self._heap = []  # (due, seq, callback, args)
+        self._seq = itertools.count()
+        self._wakeup = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or Config.BUCKET_FLUSH_WORKERS,
+            thread_name_prefix='bucket-flush'
+        )
+        self._thread = threading.Thread(target=self._run, name='bucket-flush-scheduler', daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay: float, callback, *args):
+        """Run callback(*args) on the flush pool after delay seconds"""
+        seq = next(self._seq)
+        with self._wakeup:
+            heapq.heappush(self._heap, (time.monotonic() + delay, seq, callback, args))
+            # Only wake the scheduler if this is now the earliest deadline
+            if self._heap[0][1] == seq:
+                self._wakeup.notify()
+
+    def _run(self):
+        with self._wakeup:
+            while True:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, callback, args = heapq.heappop(self._heap)
+                    try:
+                        self._executor.submit(callback, *args)
+                    except RuntimeError:
+                        return  # The pool is shut down at interpreter exit
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._wakeup.wait(timeout)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def _get_flush_scheduler() -> _FlushScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = _FlushScheduler()
+        return _scheduler
+
+
+class BucketFlusher:
+    """Coalesce bucket changes and save + publish them once per window.
+
+    touch() records a change and schedules a save; it runs when the window
+    ends or when max_pending changes have piled up, whichever comes first.
+    flush() saves synchronously and returns the new hash (used for shutdown
+    and by callers that need a durable hash right away).
+    """
+
+    def __init__(self, save: Callable[[], str], publish: Callable[[str], None],
+                 window: Optional[float] = None, max_pending: Optional[int] = None):
+        self._save = save
+        self._publish = publish
+        self.window = window if window is not None else Config.BUCKET_FLUSH_WINDOW
+        self.max_pending = max_pending or Config.BUCKET_FLUSH_MAX_PENDING
+        self.last_hash = None
+
+        self._pending = 0
+        self._timer = None  # token of the scheduled save; a cancelled save finds it replaced
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _arm(self, delay: float):
+        token = object()
+        self._timer = token
+        _get_flush_scheduler().call_later(delay, self._fire, token)
+
+    def _cancel_timer(self):
+        self._timer = None
+
+    def _fire(self, token):
+        with self._lock:
+            if self._timer is not token:
+                return  # Cancelled or superseded
+            self._timer = None
+        self._flush_in_background()
+
+    def touch(self):
+        """Record one change; a background flush will pick it up"""
+        with self._lock:
+            self._pending += 1
+            if self._pending >= self.max_pending:
+                self._cancel_timer()
+                self._arm(0)
+            elif self._timer is None:
+                self._arm(self.window)
+
+    def flush(self) -> Optional[str]:
+        """Save now and publish the hash if it changed"""
+        with self._lock:
+            self._cancel_timer()
+            self._pending = 0
+        with self._flush_lock:
+            bucket_hash = self._save()
+            if bucket_hash and bucket_hash != self.last_hash:
+                self._publish(bucket_hash)
+                self.last_hash = bucket_hash
+            return bucket_hash
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing bucket: {e}")
+            # The bucket is still dirty; try again after another window
+            with self._lock:
+                if self._timer is None:
+                    self._arm(self.window)
@@ -1,54 +1,161 @@
 import json
 import os
+import sqlite3
+import threading
+from contextlib import contextmanager
 from typing import Dict, Optional
 import time
+from config import Config
+from python_scripts.public_chat.sharded_index import ShardedIndex
 
 class BucketManager:
-    def __init__(self):
+    """Registry of each user's bucket hashes, stored in SQLite.
+
+    Every update is a single-row upsert, so a hot public room no longer
+    rewrites the whole registry. The legacy data/user_buckets.json file is
+    imported once when the database is first created. Reads are served from
+    a ShardedIndex kept in step with the table.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
         self.buckets_file = "data/user_buckets.json"
-        self.buckets_data = {}  # user_id -> {hash, sent_requests_hash, received_requests_hash, created_at} mapping
-        self._init_buckets_file()
-        
-    def _init_buckets_file(self):
-        """Initialize or load buckets file"""
+        self.db_path = db_path or Config.BUCKET_DB_PATH
+        self.buckets_data = ShardedIndex()  # user_id -> {hash, sent_requests_hash, received_requests_hash, created_at} mapping
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._init_buckets_db()
+
+    def _init_buckets_db(self):
+        """Open (or create) the buckets database and load it into memory"""
         # Create data directory if it doesn't exist
-        os.makedirs(os.path.dirname(self.buckets_file), exist_ok=True)
-        
-        # Load existing bucket data if available
-        try:
-            if os.path.exists(self.buckets_file):
-                with open(self.buckets_file, 'r') as f:
-                    self.buckets_data = json.load(f)
-        except Exception as e:
-            print(f"Error loading buckets file: {e}")
-            self.buckets_data = {}
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'user_id TEXT PRIMARY KEY, '
+            'hash TEXT, '
+            'sent_requests_hash TEXT, '
+            'received_requests_hash TEXT, '
+            'created_at REAL, '
+            'updated_at REAL)'
+        )
+
+        if self._conn.execute('SELECT COUNT(*) FROM buckets').fetchone()[0] == 0:
+            self._import_buckets_file()
+
+        self._reload()
 
-    def _save_buckets_data(self):
-        """Save buckets data to file"""
+    def _import_buckets_file(self):
+        """One-time import of the legacy JSON registry"""
         try:
-            with open(self.buckets_file, 'w') as f:
-                json.dump(self.buckets_data, f, indent=4)
+            if not os.path.exists(self.buckets_file):
+                return
+            with open(self.buckets_file, 'r') as f:
+                legacy_data = json.load(f)
+            with self.batch():
+                for user_id, info in legacy_data.items():
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO buckets '
+                        '(user_id, hash, sent_requests_hash, received_requests_hash, created_at, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (str(user_id), info.get('hash'), info.get('sent_requests_hash'),
+                         info.get('received_requests_hash'), info.get('created_at'), time.time())
+                    )
+            print(f"Imported {len(legacy_data)} buckets from {self.buckets_file}")
         except Exception as e:
-            print(f"Error saving buckets data: {e}")
-            raise
+            print(f"Error importing buckets file: {e}")
+
+    @staticmethod
+    def _row_to_info(bucket_hash, sent_hash, received_hash, created_at) -> Dict:
+        info = {}
+        if bucket_hash is not None:
+            info['hash'] = bucket_hash
+        if created_at is not None:
+            info['created_at'] = created_at
+        if sent_hash is not None:
+            info['sent_requests_hash'] = sent_hash
+        if received_hash is not None:
+            info['received_requests_hash'] = received_hash
+        return info
+
+    @contextmanager
+    def batch(self):
+        """Group several updates into one transaction (nested batches join the outer one)"""
+        with self._lock:
+            if self._batch_depth == 0:
+                self._conn.execute('BEGIN')
+            self._batch_depth += 1
+            try:
+                yield self
+            except Exception:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._conn.execute('ROLLBACK')
+                    self._reload()
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._conn.execute('COMMIT')
+
+    def _reload(self):
+        """Rebuild the in-memory index from the table (on start and after a rolled back batch)"""
+        rows = self._conn.execute(
+            'SELECT user_id, hash, sent_requests_hash, received_requests_hash, created_at, updated_at FROM buckets'
+        ).fetchall()
+        self.buckets_data.clear()
+        for user_id, bucket_hash, sent_hash, received_hash, created_at, updated_at in rows:
+            info = self._row_to_info(bucket_hash, sent_hash, received_hash, created_at)
+            self.buckets_data.set(user_id, info, updated_at or created_at or 0)
+
+    def _upsert(self, user_id: str, column: str, value: str):
+        with self.batch():
+            # Stamped under the lock and strictly increasing, so stamps follow index order
+            now = max(time.time(), self.buckets_data.latest_update() + 1e-6)
+            self._conn.execute(
+                f'INSERT INTO buckets (user_id, {column}, created_at, updated_at) VALUES (?, ?, ?, ?) '
+                f'ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at',
+                (user_id, value, now, now)
+            )
+            fields = {column: value}
+            if user_id not in self.buckets_data:
+                # Mirror the INSERT above, which stamps created_at whichever column created the row
+                fields['created_at'] = now
+            self.buckets_data.update(user_id, fields, now)
+
+    def all_buckets(self) -> Dict[str, Dict]:
+        """Snapshot of every user's bucket info"""
+        return self.buckets_data.snapshot()
+
+    def last_update_time(self) -> float:
+        """Update time of the newest change; read it before listing to get a safe ?since cursor"""
+        return self.buckets_data.latest_update()
+
+    def buckets_updated_since(self, since: float) -> Dict[str, Dict]:
+        """Bucket info for users whose hashes changed after since"""
+        updated = {}
+        for user_id, updated_at in self.buckets_data.updated_since(since):
+            info = self.buckets_data.get(user_id)
+            if info is not None:
+                updated[user_id] = dict(info, updated_at=updated_at)
+        return updated
 
     def get_bucket_hash(self, user_id: str) -> Optional[str]:
         """Get bucket hash for user"""
         bucket_info = self.buckets_data.get(str(user_id))
-        return bucket_info['hash'] if bucket_info else None
+        return bucket_info.get('hash') if bucket_info else None
 
     def update_bucket_hash(self, user_id: str, bucket_hash: str):
         """Update bucket hash for user"""
-        self.buckets_data[str(user_id)] = {
-            'hash': bucket_hash,
-            'created_at': time.time()
-        }
-        self._save_buckets_data()
+        self._upsert(str(user_id), 'hash', bucket_hash)
 
     def get_bucket_creation_time(self, user_id: str) -> Optional[float]:
         """Get bucket creation timestamp"""
         bucket_info = self.buckets_data.get(str(user_id))
-        return bucket_info['created_at'] if bucket_info else None
+        return bucket_info.get('created_at') if bucket_info else None
 
     def user_has_bucket(self, user_id: str) -> bool:
         """Check if user has a bucket"""
@@ -56,17 +163,11 @@ class BucketManager:
 
     def update_sent_requests_hash(self, user_id: str, hash: str):
         """Update sent requests hash for user"""
-        if str(user_id) not in self.buckets_data:
-            self.buckets_data[str(user_id)] = {}
-        self.buckets_data[str(user_id)]['sent_requests_hash'] = hash
-        self._save_buckets_data()
+        self._upsert(str(user_id), 'sent_requests_hash', hash)
 
     def update_received_requests_hash(self, user_id: str, hash: str):
         """Update received requests hash for user"""
-        if str(user_id) not in self.buckets_data:
-            self.buckets_data[str(user_id)] = {}
-        self.buckets_data[str(user_id)]['received_requests_hash'] = hash
-        self._save_buckets_data()
+        self._upsert(str(user_id), 'received_requests_hash', hash)
 
     def get_sent_requests_hash(self, user_id: str) -> Optional[str]:
         """Get sent requests hash for user"""
@@ -76,4 +177,4 @@ class BucketManager:
     def get_received_requests_hash(self, user_id: str) -> Optional[str]:
         """Get received requests hash for user"""
         bucket_info = self.buckets_data.get(str(user_id), {})
-        return bucket_info.get('received_requests_hash')
\ No newline at end of file
+        return bucket_info.get('received_requests_hash')
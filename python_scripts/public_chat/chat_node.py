@@ -15,7 +15,8 @@ class ChatNode:
         self.p2p_network = P2PFloodNetwork(
             host='0.0.0.0',  # Listen on all interfaces
             port=self._get_available_port(),
-            username=username
+            username=username,
+            node=self
         )
     
     def _get_available_port(self):
@@ -33,7 +34,8 @@ class ChatNode:
             'sender_id': self.node_id,
             'username': self.username,
             'content': content,
-            'timestamp': time.time()
+            'timestamp': time.time(),
+            'seq': self.secure_bucket.next_seq(self.node_id)
         }
         
         # Add message to secure bucket
@@ -54,17 +56,37 @@ class ChatNode:
         required_fields = ['id', 'sender_id', 'username', 'content', 'timestamp']
         return all(field in message for field in required_fields)
 
-    def sync_with_peer(self, peer_bucket_hash: str):
+    def sync_with_peer(self, peer_bucket_hash: str, durable: bool = False, peer_id: str = None):
         """Sync chat history with another peer"""
-        return self.secure_bucket.sync_chat_history(peer_bucket_hash)
+        return self.secure_bucket.sync_chat_history(peer_bucket_hash, durable=durable, peer_id=peer_id)
+
+    def get_version_vector(self) -> Dict[str, int]:
+        """Highest message seq this node has seen from each sender"""
+        return self.secure_bucket.get_version_vector()
+
+    def delta_since(self, vector: Dict) -> List[Dict]:
+        """Messages a peer with the given version vector is missing"""
+        return self.secure_bucket.delta_since(vector)
+
+    def apply_delta(self, messages: List[Dict], durable: bool = False):
+        """Merge messages received as a version-vector delta"""
+        return self.secure_bucket.apply_delta(messages, durable=durable)
 
     def get_chat_history(self) -> List[Dict]:
         """Get current chat history"""
         return self.secure_bucket.get_chat_history()
 
     def get_bucket_hash(self) -> str:
-        """Get current bucket hash"""
-        return self.secure_bucket._save_bucket()
+        """Get current bucket hash, saving any pending changes (or a new bucket) first"""
+        return self.secure_bucket.flush(create=True)
+
+    def shutdown(self):
+        """Save pending bucket changes and release the P2P socket, threads and temp directory"""
+        try:
+            self.secure_bucket.flush()
+        except Exception as e:
+            print(f"Error flushing bucket for node {self.node_id}: {e}")
+        self.p2p_network.close()
 
     def clear_chat_history(self) -> Dict:
         """Clear chat history from bucket"""
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from config import Config
+
+class ChatNodeRegistry:
+    """Bounded user_id -> ChatNode map with LRU eviction and an idle reaper.
+
+    Behaves like the dict it replaces (get, [], in, values, items). Every
+    lookup marks the node as recently used. Inserting past max_nodes evicts
+    the least recently used node, and a reaper thread evicts nodes idle
+    longer than idle_timeout. Evicted nodes are shut down outside the lock,
+    so their bucket is flushed and their socket, threads and temp directory
+    are released.
+    """
+
+    def __init__(self, max_nodes: Optional[int] = None, idle_timeout: Optional[float] = None,
+                 reap_interval: Optional[float] = None):
+        self.max_nodes = max_nodes or Config.CHAT_NODE_MAX
+        self.idle_timeout = idle_timeout or Config.CHAT_NODE_IDLE_TIMEOUT
+        self.reap_interval = reap_interval or Config.CHAT_NODE_REAP_INTERVAL
+        self._nodes = OrderedDict()  # user_id -> (node, last_used), least recently used first
+        self._lock = threading.RLock()
+        self._creating = {}  # user_id -> lock held while that user's node is being built
+        self._stopped = threading.Event()
+
+        self._reaper = threading.Thread(target=self._run_reaper, name='chat-node-reaper', daemon=True)
+        self._reaper.start()
+
+    def _touch(self, user_id: str):
+        node, _ = self._nodes[user_id]
+        self._nodes[user_id] = (node, time.time())
+        self._nodes.move_to_end(user_id)
+        return node
+
+    def get(self, user_id: str, default=None):
+        with self._lock:
+            if user_id not in self._nodes:
+                return default
+            return self._touch(user_id)
+
+    def __getitem__(self, user_id: str):
+        with self._lock:
+            if user_id not in self._nodes:
+                raise KeyError(user_id)
+            return self._touch(user_id)
+
+    def __setitem__(self, user_id: str, node):
+        with self._lock:
+            previous = self._nodes.pop(user_id, (None, None))[0]
+            self._nodes[user_id] = (node, time.time())
+            evicted = self._evict_over_capacity()
+        if previous is not None and previous is not node:
+            evicted.append(previous)
+        self._shutdown_nodes(evicted)
+
+    def get_or_create(self, user_id: str, factory: Callable[[], object]):
+        """Return the node for user_id, creating it with factory() if needed (at most once).
+
+        factory() runs under a per-user lock, so a slow build only holds up
+        callers asking for the same user.
+        """
+        with self._lock:
+            if user_id in self._nodes:
+                return self._touch(user_id)
+            creation_lock = self._creating.setdefault(user_id, threading.Lock())
+        try:
+            with creation_lock:
+                with self._lock:
+                    if user_id in self._nodes:
+                        return self._touch(user_id)
+                node = factory()
+                with self._lock:
+                    if user_id in self._nodes:
+                        # Stored directly while we were building; keep that one
+                        evicted, node = [node], self._touch(user_id)
+                    else:
+                        self._nodes[user_id] = (node, time.time())
+                        evicted = self._evict_over_capacity()
+        finally:
+            with self._lock:
+                if self._creating.get(user_id) is creation_lock:
+                    del self._creating[user_id]
+        self._shutdown_nodes(evicted)
+        return node
+
+    def pop(self, user_id: str, default=None):
+        """Remove a node without shutting it down"""
+        with self._lock:
+            entry = self._nodes.pop(user_id, None)
+        return entry[0] if entry else default
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._nodes
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._nodes)
+
+    def keys(self):
+        with self._lock:
+            return list(self._nodes.keys())
+
+    def values(self):
+        with self._lock:
+            return [node for node, _ in self._nodes.values()]
+
+    def items(self):
+        with self._lock:
+            return [(user_id, node) for user_id, (node, _) in self._nodes.items()]
+
+    def _evict_over_capacity(self):
+        evicted = []
+        while len(self._nodes) > self.max_nodes:
+            _, (node, _) = self._nodes.popitem(last=False)
+            evicted.append(node)
+        return evicted
+
+    def evict_idle(self):
+        """Shut down every node unused for longer than idle_timeout"""
+        cutoff = time.time() - self.idle_timeout
+        evicted = []
+        with self._lock:
+            # Ordered by last use, so stop at the first node that is still fresh
+            for user_id, (node, last_used) in list(self._nodes.items()):
+                if last_used > cutoff:
+                    break
+                del self._nodes[user_id]
+                evicted.append(node)
+        self._shutdown_nodes(evicted)
+
+    def _shutdown_nodes(self, nodes):
+        for node in nodes:
+            try:
+                node.shutdown()
+                print(f"Shut down chat node {node.node_id}")
+            except Exception as e:
+                print(f"Error shutting down chat node {getattr(node, 'node_id', '?')}: {e}")
+
+    def _run_reaper(self):
+        while not self._stopped.wait(self.reap_interval):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Error reaping idle chat nodes: {e}")
+
+    def shutdown(self):
+        """Stop the reaper and shut down every node"""
+        self._stopped.set()
+        with self._lock:
+            nodes = [node for node, _ in self._nodes.values()]
+            self._nodes.clear()
+        self._shutdown_nodes(nodes)
@@ -0,0 +1,76 @@
+from typing import Dict, Iterable, List, Set
+
+GRAM_SIZE = 3
+
+def _grams(text: str, size: int) -> Set[str]:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+class FileSearchIndex:
+    """Inverted n-gram index over file names for case-insensitive substring search.
+
+    Every 1-, 2- and 3-gram of a lowercased name points at the file ids that
+    contain it. A query intersects the postings of its own grams (trigrams
+    once it is long enough), rarest first, and confirms the few candidates
+    with a real substring check. Results come back newest first like
+    SecureBucket.search_files always returned them.
+    """
+
+    def __init__(self):
+        self._files = {}  # file_id -> file_info
+        self._names = {}  # file_id -> lowercased name
+        self._postings = {}  # gram -> set of file_ids
+
+    def _index_grams(self, name: str) -> Set[str]:
+        grams = set()
+        for size in range(1, GRAM_SIZE + 1):
+            grams |= _grams(name, size)
+        return grams
+
+    def add(self, file_info: Dict):
+        file_id = file_info['id']
+        if file_id in self._files:
+            self.remove(file_id)
+        name = file_info['name'].lower()
+        self._files[file_id] = file_info
+        self._names[file_id] = name
+        for gram in self._index_grams(name):
+            self._postings.setdefault(gram, set()).add(file_id)
+
+    def remove(self, file_id: str):
+        if file_id not in self._files:
+            return
+        name = self._names.pop(file_id)
+        del self._files[file_id]
+        for gram in self._index_grams(name):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(file_id)
+                if not posting:
+                    del self._postings[gram]
+
+    def rebuild(self, files: Iterable[Dict]):
+        self._files = {}
+        self._names = {}
+        self._postings = {}
+        for file_info in files:
+            self.add(file_info)
+
+    def search(self, query: str) -> List[Dict]:
+        """File infos whose name contains query (case-insensitive), newest first"""
+        query = query.lower()
+        if not query:
+            candidates = set(self._files)
+        else:
+            postings = []
+            for gram in _grams(query, min(len(query), GRAM_SIZE)):
+                posting = self._postings.get(gram)
+                if not posting:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            if len(query) > GRAM_SIZE:
+                # Shared trigrams don't guarantee they are adjacent in the name
+                candidates = {file_id for file_id in candidates if query in self._names[file_id]}
+        matches = [self._files[file_id] for file_id in candidates]
+        return sorted(matches, key=lambda file_info: file_info['timestamp'], reverse=True)
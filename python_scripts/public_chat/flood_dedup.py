@@ -0,0 +1,101 @@
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from config import Config
+
+class MessageDeduplicator:
+    """Time-bucketed rotating set of recently seen flood message ids.
+
+    Ids go into the newest of `buckets` sets; each set covers ttl / buckets
+    seconds, and the oldest is dropped when a new one starts. An id is
+    therefore remembered for between ttl * (buckets - 1) / buckets and ttl
+    seconds, with no false positives. A set that fills its share of
+    max_entries starts the next one early, so memory stays bounded under a
+    flood at the cost of a shorter memory. Keys are namespaced so every flood
+    network in the process can share one instance.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, buckets: Optional[int] = None,
+                 max_entries: Optional[int] = None):
+        self.ttl = ttl or Config.FLOOD_DEDUP_TTL
+        self.bucket_count = buckets or Config.FLOOD_DEDUP_BUCKETS
+        self.max_entries = max_entries or Config.FLOOD_DEDUP_MAX_ENTRIES
+        self.bucket_span = self.ttl / self.bucket_count
+        self.bucket_capacity = max(1, self.max_entries // self.bucket_count)
+        self._buckets = deque([set()])
+        self._bucket_started = time.monotonic()
+        self._entries = 0
+        self._lock = threading.Lock()
+
+        self.checks = 0
+        self.suppressed = 0
+        self.rotations = 0
+        self.early_rotations = 0
+
+    def _start_bucket(self):
+        self._buckets.append(set())
+        self.rotations += 1
+        if len(self._buckets) > self.bucket_count:
+            self._entries -= len(self._buckets.popleft())
+
+    def _rotate(self, now: float):
+        # Catch up on every span that passed, even if nothing arrived meanwhile
+        spans = int((now - self._bucket_started) // self.bucket_span)
+        for _ in range(min(spans, self.bucket_count)):
+            self._start_bucket()
+        if spans:
+            self._bucket_started += spans * self.bucket_span
+
+    def seen(self, namespace: str, message_id: str) -> bool:
+        """Record message_id for namespace; True if it was already recorded (a duplicate)"""
+        key = (namespace, message_id)
+        now = time.monotonic()
+        with self._lock:
+            self._rotate(now)
+            self.checks += 1
+            if any(key in bucket for bucket in self._buckets):
+                self.suppressed += 1
+                return True
+            if len(self._buckets[-1]) >= self.bucket_capacity:
+                self._start_bucket()
+                self._bucket_started = now
+                self.early_rotations += 1
+            self._buckets[-1].add(key)
+            self._entries += 1
+            return False
+
+    def stats(self) -> Dict:
+        """Suppression counters and an estimate of the memory held"""
+        with self._lock:
+            self._rotate(time.monotonic())
+            memory = sum(sys.getsizeof(bucket) for bucket in self._buckets)
+            sample = next((key for bucket in reversed(self._buckets) for key in bucket), None)
+            if sample is not None:
+                key_size = sys.getsizeof(sample) + sum(sys.getsizeof(part) for part in sample)
+                memory += key_size * self._entries
+            return {
+                'entries': self._entries,
+                'max_entries': self.max_entries,
+                'buckets': len(self._buckets),
+                'ttl': self.ttl,
+                'checks': self.checks,
+                'suppressed': self.suppressed,
+                'suppression_rate': self.suppressed / self.checks if self.checks else 0.0,
+                'rotations': self.rotations,
+                'early_rotations': self.early_rotations,
+                'approx_memory_bytes': memory
+            }
+
+
+_shared_deduplicator = None
+_shared_deduplicator_lock = threading.Lock()
+
+def get_message_deduplicator() -> MessageDeduplicator:
+    """Return the process-wide MessageDeduplicator shared by every P2PFloodNetwork"""
+    global _shared_deduplicator
+    with _shared_deduplicator_lock:
+        if _shared_deduplicator is None:
+            _shared_deduplicator = MessageDeduplicator()
+        return _shared_deduplicator
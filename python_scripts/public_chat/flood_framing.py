@@ -0,0 +1,107 @@
+import json
+import struct
+from typing import Dict, List, Optional
+from config import Config
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; frames fall back to JSON
+    msgpack = None
+
+# Frame layout: 4-byte big-endian length of what follows, 1 type byte, payload
+FRAME_HEADER = struct.Struct('>IB')
+
+FRAME_JSON = 1
+FRAME_MSGPACK = 2
+FRAME_BINARY = 3  # JSON header followed by raw bytes, see encode_binary
+
+# A binary frame's payload starts with the length of its JSON header
+BINARY_HEADER_LENGTH = struct.Struct('>I')
+
+
+class FrameError(Exception):
+    """Raised for frames that are oversized, truncated or of an unknown type"""
+
+
+def _wire_type(encoding: Optional[str] = None) -> int:
+    encoding = encoding or Config.FLOOD_WIRE_ENCODING
+    if encoding == 'msgpack' and msgpack is not None:
+        return FRAME_MSGPACK
+    return FRAME_JSON
+
+
+def _frame(frame_type: int, payload: bytes) -> bytes:
+    if len(payload) + 1 > Config.FLOOD_MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds the maximum frame size")
+    return FRAME_HEADER.pack(len(payload) + 1, frame_type) + payload
+
+
+def encode_message(message: Dict, encoding: Optional[str] = None) -> bytes:
+    """Encode one protocol message as a complete frame"""
+    frame_type = _wire_type(encoding)
+    if frame_type == FRAME_MSGPACK:
+        payload = msgpack.packb(message, use_bin_type=True)
+    else:
+        payload = json.dumps(message, separators=(',', ':')).encode()
+    return _frame(frame_type, payload)
+
+
+def encode_binary(header: Dict, data: bytes) -> bytes:
+    """Encode a message that carries raw bytes; the decoder puts them in message['data']"""
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    return _frame(FRAME_BINARY, BINARY_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + data)
+
+
+def decode_payload(frame_type: int, payload: bytes) -> Dict:
+    if frame_type == FRAME_JSON:
+        return json.loads(payload.decode())
+    if frame_type == FRAME_MSGPACK:
+        if msgpack is None:
+            raise FrameError("Received a msgpack frame but msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False)
+    if frame_type == FRAME_BINARY:
+        if len(payload) < BINARY_HEADER_LENGTH.size:
+            raise FrameError("Binary frame is too short to hold its header length")
+        (header_length,) = BINARY_HEADER_LENGTH.unpack_from(payload)
+        header_end = BINARY_HEADER_LENGTH.size + header_length
+        if header_end > len(payload):
+            raise FrameError("Binary frame header runs past the end of the frame")
+        try:
+            message = json.loads(payload[BINARY_HEADER_LENGTH.size:header_end].decode())
+        except ValueError as e:
+            raise FrameError(f"Binary frame header is not valid JSON: {e}")
+        if not isinstance(message, dict):
+            raise FrameError("Binary frame header is not a JSON object")
+        message['data'] = payload[header_end:]
+        return message
+    raise FrameError(f"Unknown frame type {frame_type}")
+
+
+class FrameDecoder:
+    """Incremental decoder: feed() arbitrary chunks, get back complete messages.
+
+    TCP may split or coalesce frames, so bytes are buffered until a whole
+    frame has arrived; a length over max_frame_size is rejected before any
+    of its payload is buffered.
+    """
+
+    def __init__(self, max_frame_size: Optional[int] = None):
+        self.max_frame_size = max_frame_size or Config.FLOOD_MAX_FRAME_SIZE
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Dict]:
+        self._buffer += data
+        messages = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if length < 1 or length > self.max_frame_size:
+                raise FrameError(f"Invalid frame length {length}")
+            end = offset + 4 + length  # the length counts the type byte, not itself
+            if end > len(self._buffer):
+                break
+            payload = bytes(self._buffer[offset + FRAME_HEADER.size:end])
+            messages.append(decode_payload(frame_type, payload))
+            offset = end
+        del self._buffer[:offset]
+        return messages
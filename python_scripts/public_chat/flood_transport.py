@@ -0,0 +1,332 @@
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from config import Config
+
+class PeerConnection:
+    """One peer socket owned by a FloodTransport.
+
+    send()/sendall() never block: bytes the socket cannot take right away are
+    buffered and written by the loop when the socket becomes writable.
+    Received data is handed to the owning network one chunk at a time, in
+    order, on the handler pool; reading pauses while FLOOD_INBOX_LIMIT bytes
+    are waiting for it.
+    """
+
+    def __init__(self, transport: 'FloodTransport', sock: socket.socket, address, network):
+        self.transport = transport
+        self.sock = sock
+        self.address = address
+        self.network = network
+        self.closed = False
+        self._closing = False
+        self._out = bytearray()
+        self._inbox = deque()
+        self._inbox_bytes = 0
+        self._reading_paused = False
+        self._draining = False
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+
+    def send(self, data: bytes) -> int:
+        self.transport.send(self, data)
+        return len(data)
+
+    def sendall(self, data: bytes):
+        self.transport.send(self, data)
+
+    def wait_for_drain(self, limit: int, timeout: Optional[float] = None) -> bool:
+        """Block until at most limit bytes are buffered; False if closed or timed out"""
+        with self._drained:
+            self._drained.wait_for(lambda: self.closed or len(self._out) <= limit, timeout)
+            return not self.closed and len(self._out) <= limit
+
+    def close(self):
+        """Close once everything already queued has been written"""
+        self.transport.close_connection(self)
+
+
+class FloodTransport:
+    """Process-wide selector loop multiplexing every flood listener and peer socket.
+
+    One loop thread accepts, reads and writes; handlers run on a fixed-size
+    pool, and file transfers on a second one. Thread count therefore stays constant however many ChatNodes and
+    peers there are. The selector is only touched from the loop thread;
+    other threads queue work with _call_soon() and wake it through a
+    socketpair.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.selector = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or Config.FLOOD_HANDLER_WORKERS,
+            thread_name_prefix='flood-handler'
+        )
+        # Sending a file can block for FLOOD_SEND_TIMEOUT per chunk, so it
+        # runs here rather than on the pool that drains every peer's inbox
+        self.transfer_executor = ThreadPoolExecutor(
+            max_workers=Config.FLOOD_TRANSFER_WORKERS,
+            thread_name_prefix='flood-transfer'
+        )
+        self._pending = deque()
+        self._timers = []  # heap of (due, seq, callback, args); loop thread only
+        self._timer_seq = itertools.count()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, ('wakeup', None))
+
+        self._thread = threading.Thread(target=self._run, name='flood-transport', daemon=True)
+        self._thread.start()
+
+    def _call_soon(self, callback, *args):
+        self._pending.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass  # Loop is already due to wake up
+
+    # Called from any thread
+
+    def listen(self, sock: socket.socket, network):
+        """Accept connections on a bound, listening socket for network"""
+        sock.setblocking(False)
+        self._call_soon(self.selector.register, sock, selectors.EVENT_READ, ('listener', network))
+
+    def unlisten(self, sock: socket.socket):
+        self._call_soon(self._unlisten, sock)
+
+    def add_connection(self, sock: socket.socket, address, network) -> PeerConnection:
+        """Hand a connected socket to the loop"""
+        sock.setblocking(False)
+        connection = PeerConnection(self, sock, address, network)
+        self._call_soon(self._register, connection)
+        return connection
+
+    def send(self, connection: PeerConnection, data: bytes):
+        if connection.closed or connection._closing:
+            raise ConnectionError(f"Connection to {connection.address} is closed")
+        with connection._lock:
+            if not connection._out:
+                # Nothing queued: write directly and only buffer what is left over
+                try:
+                    sent = connection.sock.send(data)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                data = data[sent:]
+                if not data:
+                    return
+            connection._out += data
+        self._call_soon(self._want_write, connection)
+
+    def run_transfer(self, callback, *args):
+        """Run a long-running send (a file or manifest) on the transfer pool"""
+        try:
+            self.transfer_executor.submit(callback, *args)
+        except RuntimeError:
+            pass  # The pool is shut down at interpreter exit
+
+    def close_connection(self, connection: PeerConnection):
+        self._call_soon(self._close_when_flushed, connection)
+
+    def call_later(self, delay: float, callback, *args):
+        """Run callback(*args) on the handler pool after delay seconds"""
+        self._call_soon(self._add_timer, time.monotonic() + delay, callback, args)
+
+    # Loop thread only
+
+    def _run(self):
+        while True:
+            try:
+                timeout = max(0, self._timers[0][0] - time.monotonic()) if self._timers else None
+                for key, mask in self.selector.select(timeout):
+                    kind, owner = key.data
+                    if kind == 'wakeup':
+                        self._drain_wakeup()
+                    elif kind == 'listener':
+                        self._accept(key.fileobj, owner)
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            self._read(owner)
+                        if mask & selectors.EVENT_WRITE and not owner.closed:
+                            self._flush(owner)
+                while self._pending:
+                    callback, args = self._pending.popleft()
+                    try:
+                        callback(*args)
+                    except Exception as e:
+                        print(f"Error in flood transport callback: {e}")
+                self._run_due_timers()
+            except Exception as e:
+                print(f"Error in flood transport loop: {e}")
+
+    def _add_timer(self, due: float, callback, args):
+        heapq.heappush(self._timers, (due, next(self._timer_seq), callback, args))
+
+    def _run_due_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            self._submit(callback, *args)
+
+    def _submit(self, callback, *args):
+        try:
+            self.executor.submit(callback, *args)
+        except RuntimeError:
+            pass  # The pool is shut down at interpreter exit
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _unlisten(self, sock: socket.socket):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    def _accept(self, listener: socket.socket, network):
+        try:
+            sock, address = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error accepting connection: {e}")
+            return
+        sock.setblocking(False)
+        connection = PeerConnection(self, sock, address, network)
+        self._register(connection)
+        network.peer_connected(connection)
+
+    def _register(self, connection: PeerConnection):
+        self._update_events(connection)
+
+    def _update_events(self, connection: PeerConnection):
+        """Select for reading unless paused, and for writing while output is buffered"""
+        if connection.closed:
+            return
+        events = 0
+        if not connection._reading_paused:
+            events |= selectors.EVENT_READ
+        if connection._out:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.get_key(connection.sock)
+            registered = True
+        except KeyError:
+            registered = False
+        if not events:
+            if registered:
+                self.selector.unregister(connection.sock)
+        elif registered:
+            self.selector.modify(connection.sock, events, ('peer', connection))
+        else:
+            self.selector.register(connection.sock, events, ('peer', connection))
+
+    def _want_write(self, connection: PeerConnection):
+        self._update_events(connection)
+
+    def _read(self, connection: PeerConnection):
+        try:
+            data = connection.sock.recv(Config.FLOOD_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(connection)
+            return
+        with connection._lock:
+            connection._inbox.append(data)
+            connection._inbox_bytes += len(data)
+            pause = connection._inbox_bytes >= Config.FLOOD_INBOX_LIMIT and not connection._reading_paused
+            if pause:
+                # Handlers are behind; let TCP flow control slow the peer down
+                connection._reading_paused = True
+            drain = not connection._draining
+            connection._draining = True
+        if pause:
+            self._update_events(connection)
+        if drain:
+            self._submit(self._drain_inbox, connection)
+
+    def _drain_inbox(self, connection: PeerConnection):
+        """Deliver a connection's received chunks in order (runs on the handler pool)"""
+        while True:
+            with connection._lock:
+                if not connection._inbox:
+                    connection._draining = False
+                    return
+                data = connection._inbox.popleft()
+                connection._inbox_bytes -= len(data)
+                resume = connection._reading_paused and connection._inbox_bytes <= Config.FLOOD_INBOX_LIMIT // 2
+                if resume:
+                    connection._reading_paused = False
+            if resume:
+                self._call_soon(self._update_events, connection)
+            try:
+                connection.network.data_received(connection, data)
+            except Exception as e:
+                print(f"Error handling peer {connection.address}: {e}")
+
+    def _flush(self, connection: PeerConnection):
+        with connection._lock:
+            try:
+                sent = connection.sock.send(connection._out)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                sent = None
+            if sent is not None:
+                del connection._out[:sent]
+                connection._drained.notify_all()
+            done = not connection._out
+        if sent is None or (done and connection._closing):
+            self._close(connection)
+        elif done:
+            self._update_events(connection)
+
+    def _close_when_flushed(self, connection: PeerConnection):
+        with connection._lock:
+            connection._closing = True
+            pending = bool(connection._out)
+        if not pending:
+            self._close(connection)
+
+    def _close(self, connection: PeerConnection):
+        if connection.closed:
+            return
+        with connection._lock:
+            connection.closed = True
+            connection._drained.notify_all()
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        connection.sock.close()
+        try:
+            connection.network.peer_disconnected(connection)
+        except Exception as e:
+            print(f"Error cleaning up peer {connection.address}: {e}")
+
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+def get_flood_transport() -> FloodTransport:
+    """Return the process-wide FloodTransport shared by every P2PFloodNetwork"""
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            _shared_transport = FloodTransport()
+        return _shared_transport
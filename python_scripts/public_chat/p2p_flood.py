@@ -1,86 +1,158 @@
+import hashlib
+import os
 import socket
-import json
-import threading
+import shutil
 from pathlib import Path
 import tempfile
+import threading
 import time
+import uuid
+from collections import OrderedDict
+from config import Config
+from python_scripts.public_chat.flood_dedup import get_message_deduplicator
+from python_scripts.public_chat.flood_framing import FrameDecoder, FrameError, encode_binary, encode_message
+from python_scripts.public_chat.flood_transport import get_flood_transport
+from python_scripts.public_chat.swarm_download import SwarmDownload
+
+class _StreamCursor:
+    """Forward-only reader over a decrypted file stream that remembers its position.
+
+    Swarm peers ask one sender for increasing ranges of the same file, so the
+    sender keeps the cursor between requests instead of decrypting from the
+    start for every piece.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.position = 0
+        self._buffer = bytearray()
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.position += len(data)
+        return data
+
+    def skip_to(self, offset):
+        while self.position < offset:
+            if not self.read(min(offset - self.position, Config.FLOOD_FILE_CHUNK_SIZE)):
+                break
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
 
 class P2PFloodNetwork:
-    def __init__(self, host, port, username):
+    def __init__(self, host, port, username, node=None):
         self.host = host
         self.port = port
         self.username = username
+        self.node = node  # The ChatNode whose bucket this network serves
         self.peers = {}  # {(host, port): connection}
         self.file_sources = {}  # {filename: [(host, port, file_id)]}
         self.temp_directory = tempfile.mkdtemp(prefix=f"p2p_flood_{username}_")
-        self.processed_messages = set()  # Track processed message IDs
+        # Flooded message ids already handled, in a store shared by every network in the process
+        self.dedup = get_message_deduplicator()
+        self.dedup_namespace = uuid.uuid4().hex
+        self.decoders = {}  # {connection: FrameDecoder}
+        self.transfers = {}  # {transfer_id: download state}
+        self.swarms = {}  # {filename: SwarmDownload}
+        self.cursors = {}  # {(connection, file_id): _StreamCursor} kept between range requests
+        self.manifests = OrderedDict()  # {(file_id, piece_size): (size, piece hashes)}, most recent last
+        # Guards the maps above, which the transport loop and handler threads share;
+        # never held while sending or calling into a swarm
+        self._lock = threading.RLock()
         
-        # Setup socket
+        # Setup socket; accepting and reading are done by the shared transport loop
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind((host, port))
         self.socket.listen(5)
-        
-        # Start listening thread
-        self.listen_thread = threading.Thread(target=self.listen_for_connections)
-        self.listen_thread.daemon = True
-        self.listen_thread.start()
-
-    def listen_for_connections(self):
-        """Listen for incoming peer connections"""
-        while True:
-            try:
-                connection, address = self.socket.accept()
-                # Start a new thread to handle this peer
-                peer_thread = threading.Thread(
-                    target=self.handle_peer,
-                    args=(connection, address)
-                )
-                peer_thread.daemon = True
-                peer_thread.start()
-                
-                # Store the connection
-                self.peers[address] = connection
-            except Exception as e:
-                print(f"Error accepting connection: {e}")
+        self.transport = get_flood_transport()
+        self.transport.listen(self.socket, self)
+
+    def peer_connected(self, connection):
+        """Called by the transport when a peer connects to us"""
+        with self._lock:
+            self.peers[connection.address] = connection
+
+    def peer_disconnected(self, connection):
+        """Called by the transport when a peer connection closes"""
+        with self._lock:
+            if self.peers.get(connection.address) is connection:
+                self.peers.pop(connection.address, None)
+            self.decoders.pop(connection, None)
+            cursors = [self.cursors.pop(key) for key in list(self.cursors) if key[0] is connection]
+            lost = [(transfer_id, transfer) for transfer_id, transfer in self.transfers.items()
+                    if transfer['connection'] is connection]
+        for cursor in cursors:
+            cursor.close()
+        # Interrupted downloads keep their .part file; requesting the file again resumes it
+        for transfer_id, transfer in lost:
+            if 'swarm' in transfer:
+                transfer['swarm'].on_peer_lost(transfer_id)
+            else:
+                self._end_transfer(transfer_id)
 
-    def handle_peer(self, connection, address):
-        """Handle messages from a connected peer"""
-        while True:
+    def data_received(self, connection, data):
+        """Buffer bytes from a peer and handle every complete frame"""
+        with self._lock:
+            if connection.closed:
+                return
+            decoder = self.decoders.get(connection)
+            if decoder is None:
+                decoder = self.decoders[connection] = FrameDecoder()
+        try:
+            messages = decoder.feed(data)
+        except (FrameError, ValueError) as e:
+            # The stream can't be resynchronised after a bad frame
+            print(f"Dropping peer {connection.address}: {e}")
+            connection.close()
+            return
+        for message in messages:
             try:
-                data = connection.recv(4096)
-                if not data:
-                    break
-                
-                message = json.loads(data.decode())
-                message_id = message.get('id')
-                
-                # Skip if we've already processed this message
-                if message_id in self.processed_messages:
-                    continue
-                    
-                self.processed_messages.add(message_id)
-                
-                # Handle different message types
-                if message['type'] == 'search':
-                    self.handle_search(message, connection)
-                elif message['type'] == 'search_response':
-                    self.handle_search_response(message)
-                elif message['type'] == 'file_request':
-                    self.handle_file_request(message, connection)
-                elif message['type'] == 'file_response':
-                    self.handle_file_response(message)
-                    
-                # Forward the message to other peers (flooding)
-                if message.get('ttl', 0) > 0:
-                    self._flood_message(message, exclude=connection)
-                    
+                self.handle_message(message, connection)
             except Exception as e:
-                print(f"Error handling peer {address}: {e}")
-                break
-                
-        # Clean up
-        connection.close()
-        self.peers.pop(address, None)
+                print(f"Error handling message from {connection.address}: {e}")
+
+    def handle_message(self, message, connection):
+        """Dispatch one decoded message from a peer"""
+        message_id = message.get('id')
+        
+        # Skip if we've already processed this message (point-to-point transfer frames carry no id)
+        if message_id is not None and self.dedup.seen(self.dedup_namespace, message_id):
+            return
+        
+        # Handle different message types
+        if message['type'] == 'search':
+            self.handle_search(message, connection)
+        elif message['type'] == 'search_response':
+            self.handle_search_response(message)
+        elif message['type'] == 'file_request':
+            self.transport.run_transfer(self.handle_file_request, message, connection)
+        elif message['type'] == 'file_header':
+            self.handle_file_header(message)
+        elif message['type'] == 'file_chunk':
+            self.handle_file_chunk(message)
+        elif message['type'] == 'file_end':
+            self.handle_file_end(message)
+        elif message['type'] == 'file_manifest_request':
+            self.transport.run_transfer(self.handle_file_manifest_request, message, connection)
+        elif message['type'] == 'file_manifest':
+            self.handle_file_manifest(message)
+        elif message['type'] == 'vv_sync':
+            self.handle_vv_sync(message, connection)
+        elif message['type'] == 'vv_delta':
+            self.handle_vv_delta(message, connection)
+            
+        # Forward the message to other peers (flooding)
+        if message.get('ttl', 0) > 0:
+            self._flood_message(message, exclude=connection)
 
     def handle_search(self, message, connection):
         """Handle incoming search request"""
@@ -96,7 +168,7 @@ class P2PFloodNetwork:
                 for file_info in local_files:
                     response = {
                         'type': 'search_response',
-                        'id': f"response_{message['id']}",
+                        'id': f"response_{message['id']}_{self.port}_{file_info['id']}",
                         'filename': file_info['name'],
                         'size': file_info['size'],
                         'host': self.host,
@@ -104,7 +176,7 @@ class P2PFloodNetwork:
                         'username': self.username,
                         'file_id': file_info['id']
                     }
-                    connection.send(json.dumps(response).encode())
+                    connection.send(encode_message(response))
         except Exception as e:
             print(f"Error handling search: {e}")
 
@@ -126,9 +198,11 @@ class P2PFloodNetwork:
             return
             
         message['ttl'] = message['ttl'] - 1
-        encoded_message = json.dumps(message).encode()
+        encoded_message = encode_message(message)
         
-        for peer in self.peers.values():
+        with self._lock:
+            peers = list(self.peers.values())
+        for peer in peers:
             if peer != exclude:
                 try:
                     peer.send(encoded_message)
@@ -136,36 +210,78 @@ class P2PFloodNetwork:
                     print(f"Error sending to peer: {e}")
 
     def handle_file_request(self, message, connection):
-        """Handle request for file download"""
+        """Stream a requested file as a file_header, binary file_chunk frames and a file_end"""
         try:
             filename = message.get('filename')
             file_id = message.get('file_id')
+            transfer_id = message.get('transfer_id')
             
-            if not filename or not file_id:
+            if not filename or not file_id or not transfer_id:
                 return
                 
-            # Get file content from local storage
-            file_content = None
+            node = self.node
+            if not node:
+                return
+            file_info = node.secure_bucket.bucket_structure['files'].get(file_id, {})
+            offset = max(0, int(message.get('offset', 0)))
+            length = message.get('length')
             
-            # Import chat_nodes here to avoid circular imports
-            from app import chat_nodes
+            # Continue this peer's previous stream of the file when it asks for a later range
+            with self._lock:
+                cursor = self.cursors.pop((connection, file_id), None)
+            if cursor is None or cursor.position > offset:
+                if cursor:
+                    cursor.close()
+                chunks = node.secure_bucket.stream_file_content(file_id)
+                if chunks is None:
+                    return
+                cursor = _StreamCursor(chunks)
+            cursor.skip_to(offset)
             
-            # Find the node that has this file
-            node_id = next((id for id, node in chat_nodes.items() 
-                           if node.p2p_network == self), None)
-            if node_id:
-                node = chat_nodes[node_id]
-                file_content = node.secure_bucket.get_file_content(file_id)
-                        
-            if file_content:
-                # Send file content back to requester
-                response = {
-                    'type': 'file_response',
-                    'id': f"file_{message.get('id')}",
-                    'filename': filename,
-                    'content': file_content.hex()  # Convert bytes to hex string
-                }
-                connection.send(json.dumps(response).encode())
+            connection.sendall(encode_message({
+                'type': 'file_header',
+                'transfer_id': transfer_id,
+                'filename': filename,
+                'file_id': file_id,
+                'size': file_info.get('size'),
+                'offset': offset,
+                'ttl': 0
+            }))
+            
+            position = offset
+            end = offset + length if length is not None else None
+            while True:
+                size = Config.FLOOD_FILE_CHUNK_SIZE if end is None else min(Config.FLOOD_FILE_CHUNK_SIZE, end - position)
+                piece = cursor.read(size) if size > 0 else b''
+                if not piece:
+                    break
+                # Don't buffer more than FLOOD_SEND_BUFFER_LIMIT for a slow peer
+                if not connection.wait_for_drain(Config.FLOOD_SEND_BUFFER_LIMIT, Config.FLOOD_SEND_TIMEOUT):
+                    print(f"Aborting transfer {transfer_id}: peer stopped reading")
+                    cursor.close()
+                    return
+                connection.sendall(encode_binary({
+                    'type': 'file_chunk',
+                    'transfer_id': transfer_id,
+                    'offset': position,
+                    'sha256': hashlib.sha256(piece).hexdigest(),
+                    'ttl': 0
+                }, piece))
+                position += len(piece)
+                
+            connection.sendall(encode_message({
+                'type': 'file_end',
+                'transfer_id': transfer_id,
+                'size': position,
+                'ttl': 0
+            }))
+            with self._lock:
+                # peer_disconnected sweeps cursors after marking the connection closed
+                keep = end is not None and position == end and not connection.closed
+                if keep:
+                    self.cursors[(connection, file_id)] = cursor
+            if not keep:
+                cursor.close()
                 
         except Exception as e:
             print(f"Error handling file request: {e}")
@@ -173,24 +289,32 @@ class P2PFloodNetwork:
     def connect_to_peer(self, host, port):
         """Establish connection to another peer"""
         try:
-            if (host, port) not in self.peers:
-                connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                connection.connect((host, port))
-                self.peers[(host, port)] = connection
-                
-                # Start thread to handle this peer
-                peer_thread = threading.Thread(
-                    target=self.handle_peer,
-                    args=(connection, (host, port))
-                )
-                peer_thread.daemon = True
-                peer_thread.start()
-                
-                return True
+            self.get_connection(host, port)
+            return True
         except Exception as e:
             print(f"Error connecting to peer {host}:{port}: {e}")
             return False
 
+    def get_connection(self, host, port):
+        """Return the open connection to a peer, connecting first if there is none"""
+        with self._lock:
+            connection = self.peers.get((host, port))
+        if connection is not None and not connection.closed:
+            return connection
+        sock = socket.create_connection((host, port), timeout=Config.FLOOD_CONNECT_TIMEOUT)
+        with self._lock:
+            existing = self.peers.get((host, port))
+            if existing is not None and not existing.closed:
+                # Another thread connected first; use its connection
+                sock.close()
+                return existing
+            connection = self.transport.add_connection(sock, (host, port), self)
+            self.peers[(host, port)] = connection
+        
+        # Reconcile public chat history with the new peer
+        self.request_vv_sync(connection)
+        return connection
+
     def flood_search(self, filename):
         """Broadcast file search to all peers"""
         search_msg = {
@@ -206,7 +330,8 @@ class P2PFloodNetwork:
         }
         
         # Clear previous search results
-        self.file_sources = {}
+        with self._lock:
+            self.file_sources = {}
         
         # Send search message to all peers
         self._flood_message(search_msg)
@@ -217,66 +342,306 @@ class P2PFloodNetwork:
         source = (response_data['host'], response_data['port'])
         file_id = response_data.get('file_id')
         
-        if filename not in self.file_sources:
-            self.file_sources[filename] = []
-        self.file_sources[filename].append((source[0], source[1], file_id))
+        with self._lock:
+            self.file_sources.setdefault(filename, []).append((source[0], source[1], file_id))
+
+    def search_results(self):
+        """Snapshot of file_sources from the last search: {filename: [(host, port, file_id)]}"""
+        with self._lock:
+            return {filename: list(sources) for filename, sources in self.file_sources.items()}
 
     def get_matching_files(self, query):
         """Get list of files matching the search query"""
         try:
-            from app import chat_nodes
-            node_id = next((id for id, node in chat_nodes.items() if node.p2p_network == self), None)
-            if node_id:
-                node = chat_nodes[node_id]
-                return node.secure_bucket.search_files(query)
+            if self.node:
+                return self.node.secure_bucket.search_files(query)
             return []
         except Exception as e:
             print(f"Error getting matching files: {e}")
             return []
 
-    def request_file(self, filename, source):
-        """Request a file from a specific peer"""
+    def request_file(self, filename, source, retries=0):
+        """Request a file from a specific peer, resuming a partial download if there is one"""
         try:
             host, port, file_id = source
+            name = Path(filename).name
+            part_path = Path(self.temp_directory) / f"{name}.part"
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            
+            # Connect to the source peer if not already connected
+            connection = self.get_connection(host, port)
+            
+            # A new request for the same file replaces any transfer still running
+            with self._lock:
+                replaced = [transfer_id for transfer_id, transfer in self.transfers.items()
+                            if transfer['filename'] == name]
+            for transfer_id in replaced:
+                self._end_transfer(transfer_id)
+            
+            transfer_id = uuid.uuid4().hex
+            self.add_transfer(transfer_id, {
+                'filename': name,
+                'source': (host, port, file_id),
+                'connection': connection,
+                'path': part_path,
+                'offset': offset,
+                'size': None,
+                'file': None,
+                'retries': retries
+            })
             request_msg = {
                 'type': 'file_request',
-                'id': f"request_{time.time()}_{self.username}",
+                'id': f"request_{transfer_id}",
+                'transfer_id': transfer_id,
                 'filename': filename,
                 'file_id': file_id,
+                'offset': offset,
                 'requester': {
                     'host': self.host,
                     'port': self.port
                 }
             }
             
-            # Connect to the source peer if not already connected
-            if (host, port) not in self.peers:
-                if not self.connect_to_peer(host, port):
-                    raise Exception("Could not connect to peer")
-                
             # Send request
-            self.peers[(host, port)].send(json.dumps(request_msg).encode())
+            connection.send(encode_message(request_msg))
+            return transfer_id
             
         except Exception as e:
             print(f"Error requesting file: {e}")
             raise
 
-    def handle_file_response(self, message):
-        """Handle incoming file response"""
+    def add_transfer(self, transfer_id, transfer):
+        """Register a download; raises if its connection already dropped, as peer_disconnected would miss it"""
+        with self._lock:
+            self.transfers[transfer_id] = transfer
+        if transfer['connection'].closed:
+            self._end_transfer(transfer_id)
+            raise ConnectionError(f"Connection to {transfer['connection'].address} is closed")
+
+    def get_transfer(self, transfer_id):
+        with self._lock:
+            return self.transfers.get(transfer_id)
+
+    def remove_transfer(self, transfer_id):
+        with self._lock:
+            return self.transfers.pop(transfer_id, None)
+
+    def _end_transfer(self, transfer_id):
+        """Forget a transfer, keeping its .part file so it can be resumed"""
+        transfer = self.remove_transfer(transfer_id)
+        if transfer and transfer.get('file'):
+            transfer['file'].close()
+        return transfer
+
+    def handle_file_header(self, message):
+        """Open the .part file for an accepted transfer at the offset the sender starts from"""
+        transfer = self.get_transfer(message.get('transfer_id'))
+        if not transfer or 'swarm' in transfer:
+            return
+        offset = int(message.get('offset', 0))
+        if offset > transfer['offset']:
+            print(f"Peer resumed {transfer['filename']} past our partial download")
+            self._end_transfer(message['transfer_id'])
+            return
+        part_file = open(transfer['path'], 'ab')
+        part_file.truncate(offset)
+        transfer.update(file=part_file, offset=offset, size=message.get('size'))
+
+    def handle_file_chunk(self, message):
+        """Append one verified chunk to its .part file; re-request from the last good offset otherwise"""
+        transfer_id = message.get('transfer_id')
+        transfer = self.get_transfer(transfer_id)
+        if transfer and 'swarm' in transfer:
+            transfer['swarm'].on_chunk(transfer_id, message)
+            return
+        if not transfer or not transfer['file']:
+            return
+        data = message['data']
+        if message.get('offset') != transfer['offset'] or hashlib.sha256(data).hexdigest() != message.get('sha256'):
+            self._end_transfer(transfer_id)
+            if transfer['retries'] >= Config.FLOOD_TRANSFER_RETRIES:
+                print(f"Giving up on {transfer['filename']} after {transfer['retries']} retries")
+                return
+            print(f"Bad chunk for {transfer['filename']} at {message.get('offset')}, resuming from {transfer['offset']}")
+            self.request_file(transfer['filename'], transfer['source'], retries=transfer['retries'] + 1)
+            return
+        transfer['file'].write(data)
+        transfer['offset'] += len(data)
+
+    def handle_file_end(self, message):
+        """Finish a transfer: rename the .part file and tell the browser it can download it"""
+        transfer_id = message.get('transfer_id')
+        transfer = self.get_transfer(transfer_id)
+        if transfer and 'swarm' in transfer:
+            transfer['swarm'].on_piece_end(transfer_id, message)
+            return
+        transfer = self._end_transfer(transfer_id)
+        if not transfer or not transfer['file']:
+            return
+        if transfer['offset'] != message.get('size'):
+            print(f"Transfer of {transfer['filename']} ended at {transfer['offset']} of {message.get('size')} bytes")
+            return
+        file_path = Path(self.temp_directory) / transfer['filename']
+        os.replace(transfer['path'], file_path)
+        
+        # Emit download ready event
+        from app import socketio
+        socketio.emit('download_ready', {
+            'url': f"/download_temp/{transfer['filename']}"
+        })
+
+    def send_to_peer(self, host, port, message):
+        """Send one message to a peer, connecting first if needed, and return the connection"""
+        connection = self.get_connection(host, port)
+        connection.sendall(encode_message(message))
+        return connection
+
+    def swarm_download(self, filename):
+        """Download filename in parallel from every source that answered the last search"""
+        with self._lock:
+            sources = list(dict.fromkeys(self.file_sources.get(filename, [])))
+        if len(sources) < 2:
+            if not sources:
+                raise Exception(f"No sources found for {filename}")
+            return self.request_file(filename, sources[0])
+        with self._lock:
+            running = self.swarms.get(filename)
+            if running is not None and not running.finished:
+                return None
+            swarm = SwarmDownload(self, filename, sources)
+            self.swarms[filename] = swarm
+        swarm.start()
+        return None
+
+    def swarm_finished(self, swarm):
+        """Forget a swarm download once it has completed or failed"""
+        with self._lock:
+            if self.swarms.get(swarm.filename) is swarm:
+                del self.swarms[swarm.filename]
+
+    def handle_file_manifest_request(self, message, connection):
+        """Reply with the file size and the SHA-256 of every piece of piece_size bytes"""
         try:
-            filename = message['filename']
-            content = bytes.fromhex(message['content'])  # Convert hex string back to bytes
-            
-            # Save file to temp directory
-            file_path = Path(self.temp_directory) / filename
-            with open(file_path, 'wb') as f:
-                f.write(content)
-            
-            # Emit download ready event
-            from app import socketio
-            socketio.emit('download_ready', {
-                'url': f'/download_temp/{filename}'
-            })
-            
+            file_id = message.get('file_id')
+            piece_size = int(message.get('piece_size', 0))
+            if not file_id or not Config.FLOOD_FILE_CHUNK_SIZE <= piece_size <= Config.FLOOD_MAX_FRAME_SIZE:
+                return
+            key = (file_id, piece_size)
+            with self._lock:
+                cached = self.manifests.get(key)
+                if cached is not None:
+                    self.manifests.move_to_end(key)
+            if cached is not None:
+                size, hashes = cached
+            else:
+                node = self.node
+                chunks = node.secure_bucket.stream_file_content(file_id) if node else None
+                if chunks is None:
+                    return
+                cursor = _StreamCursor(chunks)
+                hashes = []
+                while True:
+                    piece = cursor.read(piece_size)
+                    if not piece:
+                        break
+                    hashes.append(hashlib.sha256(piece).hexdigest())
+                size = cursor.position
+                with self._lock:
+                    self.manifests[key] = (size, hashes)
+                    while len(self.manifests) > Config.SWARM_MANIFEST_CACHE:
+                        self.manifests.popitem(last=False)
+            connection.sendall(encode_message({
+                'type': 'file_manifest',
+                'transfer_id': message.get('transfer_id'),
+                'file_id': file_id,
+                'size': size,
+                'piece_size': piece_size,
+                'hashes': hashes,
+                'ttl': 0
+            }))
+        except Exception as e:
+            print(f"Error handling file manifest request: {e}")
+
+    def handle_file_manifest(self, message):
+        """Pass a manifest to the swarm download that asked for it"""
+        transfer = self.get_transfer(message.get('transfer_id'))
+        if transfer and 'swarm' in transfer:
+            transfer['swarm'].on_manifest(message['transfer_id'], message)
+
+    def request_vv_sync(self, connection=None):
+        """Send our version vector to one peer (or all) so they reply with what we are missing"""
+        try:
+            node = self.node
+            if not node:
+                return
+            sync_msg = {
+                'type': 'vv_sync',
+                'id': f"vv_sync_{uuid.uuid4().hex}",
+                'vector': node.get_version_vector(),
+                'ttl': 0  # Point-to-point, never flooded
+            }
+            encoded_message = encode_message(sync_msg)
+            if connection:
+                peers = [connection]
+            else:
+                with self._lock:
+                    peers = list(self.peers.values())
+            for peer in peers:
+                peer.sendall(encoded_message)
+        except Exception as e:
+            print(f"Error requesting version vector sync: {e}")
+
+    def handle_vv_sync(self, message, connection):
+        """Reply to a peer's version vector with the messages it has not seen, plus our vector"""
+        try:
+            node = self.node
+            if not node:
+                return
+            response = {
+                'type': 'vv_delta',
+                'id': f"vv_delta_{uuid.uuid4().hex}",
+                'messages': node.delta_since(message.get('vector') or {}),
+                'vector': node.get_version_vector(),
+                'ttl': 0
+            }
+            connection.sendall(encode_message(response))
+        except Exception as e:
+            print(f"Error handling version vector sync: {e}")
+
+    def handle_vv_delta(self, message, connection):
+        """Merge a peer's delta; if its vector shows it lacks ours, send the reverse delta once"""
+        try:
+            node = self.node
+            if not node:
+                return
+            if message.get('messages'):
+                node.apply_delta(message['messages'])
+
+            peer_vector = message.get('vector')
+            if peer_vector is None:
+                return
+            missing = node.delta_since(peer_vector)
+            if missing:
+                response = {
+                    'type': 'vv_delta',
+                    'id': f"vv_delta_{uuid.uuid4().hex}",
+                    'messages': missing,
+                    'vector': None,  # No further round trip
+                    'ttl': 0
+                }
+                connection.sendall(encode_message(response))
         except Exception as e:
-            print(f"Error handling file response: {e}")
\ No newline at end of file
+            print(f"Error handling version vector delta: {e}")
+
+    def close(self):
+        """Stop listening, close every peer connection and remove the temp directory"""
+        self.transport.unlisten(self.socket)
+        with self._lock:
+            connections = list(self.peers.values())
+            self.peers.clear()
+            transfer_ids = list(self.transfers)
+        for connection in connections:
+            connection.close()
+        for transfer_id in transfer_ids:
+            self._end_transfer(transfer_id)
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
@@ -1,106 +1,221 @@
 from cryptography.fernet import Fernet
+import io
 import json
+import threading
 import time
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from config import Config
-from python_scripts.handlers.ipfs_handler import IPFSHandler
+from python_scripts.handlers.ipfs_handler import get_ipfs_handler, prime_stream
+from python_scripts.handlers.message_handler import MessageHandler
+from python_scripts.public_chat.bucket_flusher import BucketFlusher
+from python_scripts.public_chat.file_search_index import FileSearchIndex
 import hashlib
+import bisect
+import heapq
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Separately encrypted parts of a bucket; a small root object references their CIDs
+BUCKET_PARTS = ('metadata', 'chat_history', 'files')
+
+# Lazily loaded sections: the main bucket and the two file-request lists
+BUCKET_SECTIONS = ('main', 'sent', 'received')
+
+def _message_timestamp(message: Dict) -> float:
+    return message['timestamp']
+
+def _valid_seq(seq) -> bool:
+    return isinstance(seq, int) and not isinstance(seq, bool) and seq > 0
+
+def _sorted_by_timestamp(history: List[Dict]) -> List[Dict]:
+    """Return history sorted by timestamp, reusing it when it already is"""
+    if all(history[i]['timestamp'] <= history[i + 1]['timestamp'] for i in range(len(history) - 1)):
+        return history
+    return sorted(history, key=_message_timestamp)
+
+_load_executor = None
+_load_executor_lock = threading.Lock()
+
+def _get_load_executor() -> ThreadPoolExecutor:
+    """Shared pool that fetches bucket sections from IPFS"""
+    global _load_executor
+    with _load_executor_lock:
+        if _load_executor is None:
+            _load_executor = ThreadPoolExecutor(
+                max_workers=Config.BUCKET_LOAD_WORKERS,
+                thread_name_prefix='bucket-load'
+            )
+        return _load_executor
 
 class SecureBucket:
     def __init__(self, node_id: str, username: str):
         self.node_id = node_id
         self.username = username
         self.bucket_id = f"user_{node_id}_bucket"
-        self.ipfs_handler = IPFSHandler()
+        self.ipfs_handler = get_ipfs_handler()
         
         # Initialize Fernet cipher with existing ENCRYPTION_KEY
         self.cipher_suite = Fernet(Config.ENCRYPTION_KEY)
+        self.message_handler = MessageHandler()
+        
+        # CIDs of the last saved parts; only dirty parts are re-uploaded on save,
+        # and a bucket nobody changed is never saved
+        self._part_hashes = {}
+        self._dirty_parts = set()
+        self._root_hash = None
+        self._lock = threading.RLock()
+
+        # Saves are coalesced and published in the background (see flush for a durable save)
+        self.flusher = BucketFlusher(self._save_bucket, self._publish_hash)
         
-        # Initialize bucket structure
-        self.bucket_structure = {
+        # Sections (main bucket, sent and received requests) load lazily on first
+        # access; prefetch() starts all pending fetches concurrently
+        self._loaded = {}
+        self._futures = {}
+
+        # Peer sync bookkeeping: recently merged bucket hashes and per-peer timestamps
+        self._synced_hashes = OrderedDict()
+        self._sync_watermarks = {}
+
+        # Version vector: per sender, the highest seq up to which every message has
+        # been seen (saved in the bucket root); seqs seen past a gap wait in _seq_gaps
+        self._version_vector = {}
+        self._seq_gaps = {}
+        # Name index over bucket_structure['files']; rebuilt whenever that dict is replaced
+        self._file_index = FileSearchIndex()
+        self._file_index_source = None
+
+    def _empty_structure(self) -> Dict:
+        return {
             'metadata': {
-                'owner_id': node_id,
-                'owner_username': username,
+                'owner_id': self.node_id,
+                'owner_username': self.username,
                 'created_at': time.time(),
                 'last_updated': time.time()
             },
             'chat_history': [],
-            'files': {},
-            'file_requests': {  # Changed from 'requests' to be more specific
-                'sent': [],     
-                'received': []  
-            }
+            'files': {}
         }
-        
-        # Initialize or load existing bucket
-        self._init_bucket()
 
-    def _init_bucket(self):
-        """Initialize or load existing bucket"""
+    def prefetch(self) -> Dict[str, Future]:
+        """Start fetching every section that is not loaded yet, without waiting"""
+        with self._lock:
+            missing = [name for name in BUCKET_SECTIONS if name not in self._loaded and name not in self._futures]
+            if missing:
+                from app import bucket_manager
+                hashes = {
+                    'main': bucket_manager.get_bucket_hash(self.node_id),
+                    'sent': bucket_manager.get_sent_requests_hash(self.node_id),
+                    'received': bucket_manager.get_received_requests_hash(self.node_id)
+                }
+                print(f"Loading bucket data - Main: {hashes['main']}, Sent: {hashes['sent']}, Received: {hashes['received']}")
+                executor = _get_load_executor()
+                for name in missing:
+                    if name == 'main':
+                        self._futures[name] = executor.submit(self._load_main_section, hashes[name])
+                    else:
+                        self._futures[name] = executor.submit(self._load_requests_section, hashes[name], name)
+            return dict(self._futures)
+
+    def _section(self, name: str):
+        """Return a loaded section, waiting for (or starting) its fetch"""
+        if name in self._loaded:
+            return self._loaded[name]
+        future = self.prefetch().get(name)
+        if future is None:
+            return self._loaded[name]
         try:
-            from app import bucket_manager
-            main_bucket_hash = bucket_manager.get_bucket_hash(self.node_id)
-            sent_requests_hash = bucket_manager.get_sent_requests_hash(self.node_id)
-            received_requests_hash = bucket_manager.get_received_requests_hash(self.node_id)
-            
-            print(f"Loading bucket data - Main: {main_bucket_hash}, Sent: {sent_requests_hash}, Received: {received_requests_hash}")
-            
-            # Initialize empty structures
-            self.bucket_structure = {
-                'metadata': {
-                    'owner_id': self.node_id,
-                    'owner_username': self.username,
-                    'created_at': time.time(),
-                    'last_updated': time.time()
-                },
-                'chat_history': [],
-                'files': {}
-            }
-            
-            self.sent_requests = []
-            self.received_requests = []
-            
-            # Load main bucket
-            if main_bucket_hash:
-                encrypted_data = self.ipfs_handler.get_content(main_bucket_hash)
-                if encrypted_data:
-                    loaded_structure = self._decrypt_data(encrypted_data)
-                    self._merge_bucket_structures(loaded_structure)
-            
-            # Load sent requests
-            if sent_requests_hash:
-                try:
-                    encrypted_data = self.ipfs_handler.get_content(sent_requests_hash)
-                    if encrypted_data:
-                        self.sent_requests = self._decrypt_data(encrypted_data)
-                        print(f"Loaded {len(self.sent_requests)} sent requests")
-                except Exception as e:
-                    print(f"Error loading sent requests: {e}")
-            
-            # Load received requests
-            if received_requests_hash:
-                try:
-                    encrypted_data = self.ipfs_handler.get_content(received_requests_hash)
-                    if encrypted_data:
-                        self.received_requests = self._decrypt_data(encrypted_data)
-                        print(f"Loaded {len(self.received_requests)} received requests")
-                except Exception as e:
-                    print(f"Error loading received requests: {e}")
-                    
+            result = future.result()
         except Exception as e:
             print(f"Error initializing buckets: {e}")
+            # Forget the failed fetch so the next access retries it
+            with self._lock:
+                if self._futures.get(name) is future:
+                    del self._futures[name]
             raise
+        with self._lock:
+            if self._futures.get(name) is future:
+                del self._futures[name]
+                if name == 'main':
+                    self._apply_main_section(*result)
+                else:
+                    self._loaded[name] = result
+            return self._loaded[name]
+
+    def _set_section(self, name: str, value):
+        with self._lock:
+            self._futures.pop(name, None)
+            self._loaded[name] = value
+
+    @property
+    def bucket_structure(self) -> Dict:
+        return self._section('main')
+
+    @bucket_structure.setter
+    def bucket_structure(self, value: Dict):
+        self._set_section('main', value)
+
+    @property
+    def sent_requests(self) -> List:
+        return self._section('sent')
 
-    def _merge_bucket_structures(self, loaded_structure):
-        """Merge loaded structure with current structure while preserving existing data"""
+    @sent_requests.setter
+    def sent_requests(self, value: List):
+        self._set_section('sent', value)
+
+    @property
+    def received_requests(self) -> List:
+        return self._section('received')
+
+    @received_requests.setter
+    def received_requests(self, value: List):
+        self._set_section('received', value)
+
+    def _load_main_section(self, main_bucket_hash: Optional[str]):
+        """Fetch the main bucket; runs on the load pool"""
+        structure = self._empty_structure()
+        root = None
+        if main_bucket_hash:
+            loaded_structure, root = self._fetch_bucket(main_bucket_hash)
+            self._merge_bucket_structures(structure, loaded_structure)
+        return structure, root, main_bucket_hash
+
+    def _apply_main_section(self, structure: Dict, root: Optional[Dict], main_bucket_hash: Optional[str]):
+        self._loaded['main'] = structure
+        self._version_vector = dict(root.get('version_vector', {})) if root else {}
+        self._seq_gaps = {}
+        self._note_versions(structure['chat_history'])
+        if root is not None:
+            # Already in parts format; nothing needs re-uploading yet
+            self._part_hashes = dict(root['parts'])
+            self._dirty_parts = set()
+            self._root_hash = main_bucket_hash
+            self.flusher.last_hash = main_bucket_hash
+
+    def _load_requests_section(self, requests_hash: Optional[str], name: str) -> List:
+        """Fetch the sent or received requests list; runs on the load pool"""
+        if not requests_hash:
+            return []
+        try:
+            encrypted_data = self.ipfs_handler.get_content(requests_hash)
+            if encrypted_data:
+                requests = self._decrypt_data(encrypted_data)
+                print(f"Loaded {len(requests)} {name} requests")
+                return requests
+        except Exception as e:
+            print(f"Error loading {name} requests: {e}")
+        return []
+
+    def _merge_bucket_structures(self, structure, loaded_structure):
+        """Merge loaded structure into structure while preserving existing data"""
         for key, value in loaded_structure.items():
-            if key in self.bucket_structure:
+            if key in structure:
                 if isinstance(value, dict):
-                    self.bucket_structure[key].update(value)
+                    structure[key].update(value)
                 elif isinstance(value, list):
-                    self.bucket_structure[key].extend(value)
+                    structure[key].extend(value)
                 else:
-                    self.bucket_structure[key] = value
+                    structure[key] = value
 
     def _encrypt_data(self, data: dict) -> bytes:
         """Encrypt data before storing in IPFS"""
@@ -190,9 +305,10 @@ class SecureBucket:
             sent_hash = self.ipfs_handler.add_content(self._encrypt_data([]))
             received_hash = self.ipfs_handler.add_content(self._encrypt_data([]))
             
-            # Update bucket manager
-            bucket_manager.update_sent_requests_hash(self.node_id, sent_hash)
-            bucket_manager.update_received_requests_hash(self.node_id, received_hash)
+            # Update bucket manager in a single transaction
+            with bucket_manager.batch():
+                bucket_manager.update_sent_requests_hash(self.node_id, sent_hash)
+                bucket_manager.update_received_requests_hash(self.node_id, received_hash)
         
         except Exception as e:
             print(f"Error clearing all requests: {e}")
@@ -231,24 +347,118 @@ class SecureBucket:
         decrypted_data = self.cipher_suite.decrypt(encrypted_data)
         return json.loads(decrypted_data)
 
+    def _mark_dirty(self, *parts: str):
+        self._dirty_parts.update(parts)
+
+    def _changed(self, *parts: str, durable: bool = False) -> Optional[str]:
+        """Record a mutation; with durable=True save now and return the new hash"""
+        with self._lock:
+            self._mark_dirty(*parts)
+        if durable:
+            return self.flusher.flush()
+        self.flusher.touch()
+        return self._root_hash
+
+    def flush(self, create: bool = False) -> Optional[str]:
+        """Save any pending changes now and return the published bucket hash.
+
+        Without create, a bucket that was never saved and has no changes stays
+        unsaved (and the result is None).
+        """
+        if create:
+            with self._lock:
+                self._section('main')
+                if not self._root_hash:
+                    self._mark_dirty(*BUCKET_PARTS)
+        return self.flusher.flush()
+
+    def _publish_hash(self, bucket_hash: str):
+        from app import bucket_manager, socketio
+        bucket_manager.update_bucket_hash(self.node_id, bucket_hash)
+        socketio.emit('bucket_updated', {
+            'user_id': self.node_id,
+            'bucket_hash': bucket_hash
+        }, room=f"user_{self.node_id}")
+
     def _save_bucket(self) -> str:
-        """Save encrypted bucket to IPFS"""
+        """Save encrypted bucket to IPFS, re-uploading only the parts that changed"""
         try:
-            # Update last modified timestamp
-            self.bucket_structure['metadata']['last_updated'] = time.time()
-            
-            # Encrypt and save
-            encrypted_data = self._encrypt_data(self.bucket_structure)
-            return self.ipfs_handler.add_content(encrypted_data)
+            # Snapshot the dirty parts under the lock; encrypt and upload outside it
+            with self._lock:
+                # Mutations load the main bucket, so nothing dirty means nothing to load or save
+                if not self._dirty_parts:
+                    return self._root_hash
+                self._section('main')
+
+                # Update last modified timestamp (kept in the root so metadata stays unchanged)
+                self.bucket_structure['metadata']['last_updated'] = time.time()
+                last_updated = self.bucket_structure['metadata']['last_updated']
+                dirty = {
+                    part: json.dumps(self.bucket_structure.get(part, {}))
+                    for part in BUCKET_PARTS
+                    if part in self._dirty_parts or part not in self._part_hashes
+                }
+                self._dirty_parts.clear()
+
+            try:
+                uploaded = {
+                    part: self.ipfs_handler.add_content(self.cipher_suite.encrypt(data.encode()))
+                    for part, data in dirty.items()
+                }
+
+                with self._lock:
+                    self._part_hashes.update(uploaded)
+                    root = {
+                        'type': 'bucket_root',
+                        'version': 1,
+                        'last_updated': last_updated,
+                        'parts': dict(self._part_hashes),
+                        'version_vector': dict(self._version_vector)
+                    }
+                root_hash = self.ipfs_handler.add_content(self._encrypt_data(root))
+            except Exception:
+                # Nothing new was published; the next save must retry these parts
+                with self._lock:
+                    self._mark_dirty(*dirty)
+                raise
+
+            with self._lock:
+                self._root_hash = root_hash
+            return root_hash
         except Exception as e:
             print(f"Error saving bucket: {e}")
             raise
 
+    def _fetch_bucket(self, bucket_hash: str, parts=BUCKET_PARTS):
+        """Load the requested parts of a bucket.
+
+        Returns (structure, root); root is None for a legacy single-object
+        bucket, which always yields every part.
+        """
+        data = self._decrypt_data(self.ipfs_handler.get_content(bucket_hash))
+        if data.get('type') != 'bucket_root':
+            return data, None
+
+        structure = {}
+        for part in parts:
+            part_hash = data['parts'].get(part)
+            if part_hash:
+                structure[part] = self._decrypt_data(self.ipfs_handler.get_content(part_hash))
+        if 'metadata' in structure:
+            structure['metadata']['last_updated'] = data.get('last_updated')
+        return structure, data
+
     def _load_bucket(self, bucket_hash: str):
         """Load and decrypt bucket from IPFS"""
         try:
-            encrypted_data = self.ipfs_handler.get_content(bucket_hash)
-            self.bucket_structure = self._decrypt_data(encrypted_data)
+            structure, root = self._fetch_bucket(bucket_hash)
+            with self._lock:
+                self._futures.pop('main', None)
+                self._apply_main_section(structure, root, bucket_hash)
+                if root is None:
+                    self._part_hashes = {}
+                    self._dirty_parts = set(BUCKET_PARTS)
+                    self._root_hash = None
         except Exception as e:
             print(f"Error loading bucket: {e}")
             raise
@@ -263,8 +473,8 @@ class SecureBucket:
             print(f"Error getting bucket hash: {e}")
             return None
 
-    def add_chat_message(self, message: Dict) -> str:
-        """Add chat message to bucket"""
+    def add_chat_message(self, message: Dict, durable: bool = False) -> Optional[str]:
+        """Add chat message to bucket; the save is deferred unless durable"""
         try:
             # Create a copy of the message for storage
             storage_message = message.copy()
@@ -274,35 +484,35 @@ class SecureBucket:
                 message['content'].encode()
             ).decode()
             
-            # Add message to chat history
-            self.bucket_structure['chat_history'].append(storage_message)
-            
-            # Keep only last 100 messages
-            if len(self.bucket_structure['chat_history']) > 100:
-                self.bucket_structure['chat_history'] = self.bucket_structure['chat_history'][-100:]
+            with self._lock:
+                history = self.bucket_structure['chat_history']
+                if any(existing['id'] == storage_message['id'] for existing in history):
+                    return self._root_hash
+                
+                # Add message to chat history, keeping it sorted by timestamp
+                # (peer messages can arrive late)
+                bisect.insort(history, storage_message, key=_message_timestamp)
+                self._note_versions([storage_message])
+                
+                # Keep only the most recent messages
+                limit = Config.PUBLIC_CHAT_HISTORY_LIMIT
+                if len(history) > limit:
+                    self.bucket_structure['chat_history'] = history[-limit:]
             
-            # Save updated bucket and return new hash
-            return self._save_bucket()
+            # Schedule a coalesced save (or save now) and return the latest hash
+            return self._changed('chat_history', durable=durable)
         except Exception as e:
             print(f"Error adding chat message: {e}")
             raise
 
-    def get_chat_history(self) -> List[Dict]:
-        """Get decrypted chat history"""
-        try:
-            decrypted_history = []
-            for message in self.bucket_structure['chat_history']:
-                # Create a copy of the message
-                decrypted_message = message.copy()
-                # Decrypt only the content
-                decrypted_message['content'] = self.cipher_suite.decrypt(
-                    message['content'].encode()
-                ).decode()
-                decrypted_history.append(decrypted_message)
-            return decrypted_history
-        except Exception as e:
-            print(f"Error getting chat history: {e}")
-            return []
+    def _indexed_files(self) -> FileSearchIndex:
+        """The file name index, rebuilt if the files dict was replaced (e.g. by a load)"""
+        files = self.bucket_structure.get('files')
+        with self._lock:
+            if self._file_index_source is not files:
+                self._file_index.rebuild((files or {}).values())
+                self._file_index_source = files
+            return self._file_index
 
     def search_files(self, query: str) -> list:
         """Search for files in bucket matching the query"""
@@ -310,79 +520,192 @@ class SecureBucket:
             if 'files' not in self.bucket_structure:
                 return []
                 
-            query = query.lower()
-            matching_files = []
+            with self._lock:
+                matches = self._indexed_files().search(query)
             
-            for file_info in self.bucket_structure['files'].values():
-                if query in file_info['name'].lower():
-                    # Add download URL to file info
-                    file_data = file_info.copy()
-                    file_data['downloadUrl'] = f"/api/share_file/{file_data['id']}/{file_data['name']}"
-                    matching_files.append(file_data)
+            matching_files = []
+            for file_info in matches:
+                # Add download URL to file info
+                file_data = file_info.copy()
+                file_data['downloadUrl'] = f"/api/share_file/{file_data['id']}/{file_data['name']}"
+                matching_files.append(file_data)
             
-            return sorted(matching_files, key=lambda x: x['timestamp'], reverse=True)
+            return matching_files
             
         except Exception as e:
             print(f"Error searching files: {e}")
             return []
 
+    def _decrypt_content(self, content: str) -> str:
+        return self.cipher_suite.decrypt(content.encode()).decode()
+
     def get_chat_history(self) -> List[Dict]:
         """Get decrypted chat history"""
         try:
+            history = self.bucket_structure['chat_history']
+            # Decrypt only the content, as one parallel batch
+            contents = self.message_handler.decrypt_many(
+                (message['content'] for message in history),
+                decoder=self._decrypt_content
+            )
             decrypted_history = []
-            for message in self.bucket_structure['chat_history']:
+            for message, content in zip(history, contents):
                 # Create a copy of the message
                 decrypted_message = message.copy()
-                # Decrypt only the content
-                decrypted_message['content'] = self.cipher_suite.decrypt(
-                    message['content'].encode()
-                ).decode()
+                decrypted_message['content'] = content if content is not None else "Error: Could not decrypt message"
                 decrypted_history.append(decrypted_message)
             return decrypted_history
         except Exception as e:
             print(f"Error getting chat history: {e}")
             return []
 
-    def sync_chat_history(self, peer_bucket_hash: str):
-        """Sync chat history with another peer's bucket"""
+    def sync_chat_history(self, peer_bucket_hash: str, durable: bool = False, peer_id: Optional[str] = None):
+        """Sync chat history with another peer's bucket.
+
+        A bucket hash that was already merged is skipped outright. With a
+        peer_id, only messages newer than that peer's watermark are merged.
+        """
         try:
-            # Get peer's bucket
-            encrypted_data = self.ipfs_handler.get_content(peer_bucket_hash)
-            peer_bucket = self._decrypt_data(encrypted_data)
-            
-            # Merge chat histories
-            merged_history = self._merge_chat_histories(
-                self.bucket_structure['chat_history'],
-                peer_bucket['chat_history']
-            )
-            
-            # Update local history
-            self.bucket_structure['chat_history'] = merged_history
+            peer_id = str(peer_id) if peer_id is not None else None
+            with self._lock:
+                already_merged = peer_bucket_hash in self._synced_hashes
+                if already_merged:
+                    self._synced_hashes.move_to_end(peer_bucket_hash)
+            # Flush outside the lock: the flusher takes its own lock before ours
+            if already_merged:
+                return self.flush() if durable else self._root_hash
+            
+            # Get peer's bucket (only its chat history part)
+            peer_bucket, _ = self._fetch_bucket(peer_bucket_hash, parts=('chat_history',))
+            incoming = _sorted_by_timestamp(peer_bucket.get('chat_history', []))
+            
+            with self._lock:
+                since = self._sync_watermarks.get(peer_id) if peer_id else None
+                if since is not None:
+                    # Allow for clock skew between peers
+                    cutoff = since - Config.CHAT_SYNC_WATERMARK_SKEW
+                    incoming = incoming[bisect.bisect_right(incoming, cutoff, key=_message_timestamp):]
+                
+                # Merge chat histories
+                history = _sorted_by_timestamp(self.bucket_structure['chat_history'])
+                merged_history = self._merge_chat_histories(history, incoming)
+                changed = [m['id'] for m in merged_history] != [m['id'] for m in history]
+                
+                # Update local history
+                self.bucket_structure['chat_history'] = merged_history
+                self._note_versions(incoming)
+                if peer_id and incoming:
+                    self._sync_watermarks[peer_id] = max(since or 0, incoming[-1]['timestamp'])
+                self._synced_hashes[peer_bucket_hash] = True
+                while len(self._synced_hashes) > Config.CHAT_SYNC_HASH_MEMORY:
+                    self._synced_hashes.popitem(last=False)
             
             # Save updated bucket
-            return self._save_bucket()
+            if changed:
+                return self._changed('chat_history', durable=durable)
+            return self.flush() if durable else self._root_hash
             
         except Exception as e:
             print(f"Error syncing chat history: {e}")
             raise
 
-    def _merge_chat_histories(self, history1: List[Dict], history2: List[Dict]) -> List[Dict]:
-        """Merge two chat histories, removing duplicates"""
-        # Combine histories and sort by timestamp
-        all_messages = {msg['id']: msg for msg in history1 + history2}
-        merged = list(all_messages.values())
-        return sorted(merged, key=lambda x: x['timestamp'])
+    def _note_versions(self, messages: List[Dict]):
+        """Advance the version vector over contiguous seqs only; caller holds the lock.
+
+        Bucket-hash sync can skip messages, so a seq past a gap is only
+        remembered until the missing ones arrive (e.g. in a delta).
+        """
+        for message in messages:
+            seq = message.get('seq')
+            if not _valid_seq(seq):
+                continue
+            sender = str(message['sender_id'])
+            current = self._version_vector.get(sender, 0)
+            if seq <= current:
+                continue
+            waiting = self._seq_gaps.setdefault(sender, set())
+            waiting.add(seq)
+            while current + 1 in waiting:
+                current += 1
+                waiting.discard(current)
+                self._version_vector[sender] = current
+            if not waiting:
+                del self._seq_gaps[sender]
+            elif len(waiting) > Config.PUBLIC_CHAT_HISTORY_LIMIT:
+                # Forgetting a seen seq only means it may be sent again
+                waiting.discard(max(waiting))
+
+    def next_seq(self, sender_id) -> int:
+        """Reserve the next sequence number for a message from sender_id"""
+        with self._lock:
+            self._section('main')
+            sender = str(sender_id)
+            seq = max([self._version_vector.get(sender, 0)] + list(self._seq_gaps.pop(sender, ()))) + 1
+            self._version_vector[sender] = seq
+            return seq
+
+    def get_version_vector(self) -> Dict[str, int]:
+        with self._lock:
+            self._section('main')
+            return dict(self._version_vector)
+
+    def delta_since(self, vector: Dict) -> List[Dict]:
+        """Stored messages a peer with this version vector has not seen (content stays encrypted)"""
+        with self._lock:
+            return [
+                message for message in self.bucket_structure['chat_history']
+                if _valid_seq(message.get('seq'))
+                and message['seq'] > int(vector.get(str(message['sender_id']), 0))
+            ]
+
+    def apply_delta(self, messages: List[Dict], durable: bool = False) -> Optional[str]:
+        """Merge stored-form messages received from a peer's delta_since"""
+        # Peers are untrusted: drop anything that would break the merge or the vector
+        incoming = _sorted_by_timestamp([
+            message for message in messages
+            if isinstance(message, dict)
+            and isinstance(message.get('id'), str)
+            and isinstance(message.get('content'), str)
+            and isinstance(message.get('sender_id'), (str, int))
+            and isinstance(message.get('timestamp'), (int, float))
+            and not isinstance(message['timestamp'], bool)
+            and (message.get('seq') is None or _valid_seq(message['seq']))
+        ])
+        with self._lock:
+            history = _sorted_by_timestamp(self.bucket_structure['chat_history'])
+            merged_history = self._merge_chat_histories(history, incoming)
+            changed = [m['id'] for m in merged_history] != [m['id'] for m in history]
+            self.bucket_structure['chat_history'] = merged_history
+            self._note_versions(incoming)
+        if changed:
+            return self._changed('chat_history', durable=durable)
+        return self.flush() if durable else self._root_hash
+
+    def _merge_chat_histories(self, history1: List[Dict], history2: List[Dict], limit: Optional[int] = None) -> List[Dict]:
+        """Merge two timestamp-sorted histories, removing duplicates and keeping the newest `limit`"""
+        limit = limit or Config.PUBLIC_CHAT_HISTORY_LIMIT
+        merged = []
+        seen_ids = set()
+        # Walk both histories newest first so the cap bounds the work
+        for message in heapq.merge(reversed(history1), reversed(history2), key=_message_timestamp, reverse=True):
+            if message['id'] in seen_ids:
+                continue
+            seen_ids.add(message['id'])
+            merged.append(message)
+            if len(merged) >= limit:
+                break
+        merged.reverse()
+        return merged
 
     def add_file(self, file_content: bytes, filename: str) -> dict:
         """Add a file to the bucket"""
         try:
             file_id = hashlib.sha256(f"{self.node_id}:{time.time()}".encode()).hexdigest()
             
-            # Encrypt file content using Fernet cipher
-            encrypted_content = self.cipher_suite.encrypt(file_content)
-            
-            # Add encrypted file to IPFS
-            ipfs_hash = self.ipfs_handler.add_content(encrypted_content)
+            # Encrypt in authenticated frames while streaming to IPFS
+            ipfs_hash = self.ipfs_handler.add_stream(
+                lambda: self.message_handler.encrypt_file_stream(io.BytesIO(file_content))
+            )
             print(f"Added file to IPFS with hash: {ipfs_hash}")
             
             # Add file metadata to bucket
@@ -393,16 +716,14 @@ class SecureBucket:
                 'timestamp': time.time(),
                 'size': len(file_content)
             }
-            self.bucket_structure['files'][file_id] = file_info
+            with self._lock:
+                self.bucket_structure['files'][file_id] = file_info
+                self._indexed_files().add(file_info)
             
-            # Save updated bucket to IPFS
-            new_bucket_hash = self._save_bucket()
+            # Save updated bucket to IPFS and publish the new hash
+            new_bucket_hash = self._changed('files', durable=True)
             print(f"Updated bucket hash: {new_bucket_hash}")
             
-            # Update bucket manager with new hash
-            from app import bucket_manager
-            bucket_manager.update_bucket_hash(self.node_id, new_bucket_hash)
-            
             return file_info
         
         except Exception as e:
@@ -421,13 +742,25 @@ class SecureBucket:
             # Get encrypted content from IPFS
             encrypted_content = self.ipfs_handler.get_content(file_info['ipfs_hash'])
             
-            # Decrypt and return content
-            return self.cipher_suite.decrypt(encrypted_content)
+            # Decrypt and return content (chunked or legacy Fernet format)
+            return self.message_handler.decrypt_file(encrypted_content)
         
         except Exception as e:
             print(f"Error getting file content: {e}")
             raise
 
+    def stream_file_content(self, file_id: str) -> Optional[Iterator[bytes]]:
+        """Stream decrypted file content from bucket in chunks"""
+        if file_id not in self.bucket_structure['files']:
+            return None
+
+        file_info = self.bucket_structure['files'][file_id]
+
+        # Decrypt frame by frame as the ciphertext streams in from IPFS
+        return prime_stream(self.message_handler.decrypt_file_stream(
+            self.ipfs_handler.cat_stream(file_info['ipfs_hash'])
+        ))
+
     def get_files(self) -> list:
         """Get list of files in bucket"""
         try:
@@ -449,10 +782,12 @@ class SecureBucket:
         try:
             if file_id in self.bucket_structure['files']:
                 # Remove file from bucket structure
-                del self.bucket_structure['files'][file_id]
+                with self._lock:
+                    del self.bucket_structure['files'][file_id]
+                    self._indexed_files().remove(file_id)
                 
                 # Save updated bucket to IPFS
-                self._save_bucket()
+                self._changed('files')
                 return True
             
             return False
@@ -464,14 +799,11 @@ class SecureBucket:
         """Clear all chat history from bucket"""
         try:
             # Clear the chat history array
-            self.bucket_structure['chat_history'] = []
-            
-            # Save the updated bucket to IPFS
-            new_hash = self._save_bucket()
+            with self._lock:
+                self.bucket_structure['chat_history'] = []
             
-            # Update the bucket manager with new hash
-            from app import bucket_manager
-            bucket_manager.update_bucket_hash(self.node_id, new_hash)
+            # Save the updated bucket to IPFS and publish the new hash
+            new_hash = self._changed('chat_history', durable=True)
             
             return {
                 'success': True,
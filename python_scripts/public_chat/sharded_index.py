@@ -0,0 +1,102 @@
+import bisect
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+from config import Config
+
+class ShardedIndex:
+    """Thread-safe string-keyed map split over lock-striped shards.
+
+    Writers to different shards never contend. Iteration goes over a
+    snapshot taken one shard at a time, so readers never see a dict change
+    size under them. Entries also carry an updated_at time, kept in a sorted
+    secondary index so recent changes can be found without a full scan.
+    """
+
+    def __init__(self, shard_count: Optional[int] = None):
+        self.shard_count = shard_count or Config.BUCKET_INDEX_SHARDS
+        self._shards = [{} for _ in range(self.shard_count)]
+        self._locks = [threading.Lock() for _ in range(self.shard_count)]
+        self._updated = {}  # key -> updated_at
+        self._by_time = []  # sorted (updated_at, key)
+        self._time_lock = threading.Lock()
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self.shard_count
+
+    def _touch(self, key: str, updated_at: float):
+        with self._time_lock:
+            previous = self._updated.get(key)
+            if previous is not None:
+                index = bisect.bisect_left(self._by_time, (previous, key))
+                if index < len(self._by_time) and self._by_time[index] == (previous, key):
+                    del self._by_time[index]
+            self._updated[key] = updated_at
+            bisect.insort(self._by_time, (updated_at, key))
+
+    def get(self, key: str, default=None):
+        shard = self._shard(key)
+        with self._locks[shard]:
+            value = self._shards[shard].get(key)
+        return dict(value) if value is not None else default
+
+    def set(self, key: str, value: Dict, updated_at: float):
+        shard = self._shard(key)
+        with self._locks[shard]:
+            self._shards[shard][key] = dict(value)
+        self._touch(key, updated_at)
+
+    def update(self, key: str, fields: Dict, updated_at: float) -> Dict:
+        """Merge fields into the entry for key (creating it) and return the result"""
+        shard = self._shard(key)
+        with self._locks[shard]:
+            value = dict(self._shards[shard].get(key, {}))
+            value.update(fields)
+            self._shards[shard][key] = value
+        self._touch(key, updated_at)
+        return dict(value)
+
+    def clear(self):
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                shard.clear()
+        with self._time_lock:
+            self._updated.clear()
+            self._by_time.clear()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Copy of every entry, taken shard by shard"""
+        result = {}
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                result.update((key, dict(value)) for key, value in shard.items())
+        return result
+
+    def updated_since(self, since: float) -> List[Tuple[str, float]]:
+        """Keys changed strictly after since, oldest first, with their update times"""
+        with self._time_lock:
+            # chr(0x10FFFF) sorts after any key, skipping entries stamped exactly at since
+            start = bisect.bisect_right(self._by_time, (since, chr(0x10FFFF)))
+            return [(key, updated_at) for updated_at, key in self._by_time[start:]]
+
+    def latest_update(self) -> float:
+        """The most recent update time in the index (0.0 when empty)"""
+        with self._time_lock:
+            return self._by_time[-1][0] if self._by_time else 0.0
+
+    def __contains__(self, key: str) -> bool:
+        shard = self._shard(key)
+        with self._locks[shard]:
+            return key in self._shards[shard]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def keys(self):
+        return self.snapshot().keys()
+
+    def items(self):
+        return self.snapshot().items()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.snapshot())
@@ -0,0 +1,276 @@
+import hashlib
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from python_scripts.public_chat.flood_framing import encode_message
+
+class SwarmDownload:
+    """Download one file in pieces from every peer that answered a flood search.
+
+    The first source that answers a file_manifest_request fixes the file size
+    and the SHA-256 of every piece. Pieces are then requested as byte ranges,
+    one at a time per peer, fastest measured peer first. Each piece is checked
+    against the manifest before it is written to <name>.part. A peer that
+    sends a bad piece is dropped, and a peer that stalls has its piece handed
+    to someone else. A .part file left by an earlier attempt is re-verified
+    piece by piece, so finished pieces are not fetched again.
+    """
+
+    def __init__(self, network, filename: str, sources: List[Tuple], piece_size: Optional[int] = None):
+        self.network = network
+        self.filename = Path(filename).name
+        self.piece_size = piece_size or Config.SWARM_PIECE_SIZE
+        self.path = Path(network.temp_directory) / f"{self.filename}.part"
+        self.size = None
+        self.piece_hashes = None
+        self.pending = deque()  # piece indexes not yet assigned
+        self.done = set()
+        self.peers = {}  # source -> {'rate', 'busy', 'failures'}
+        for source in sources:
+            self.peers[tuple(source)] = {'rate': None, 'busy': None, 'failures': 0}
+        self.active = {}  # transfer_id -> {'source', 'piece', 'buffer', 'started', 'last_progress'}
+        self.finished = False
+        self._manifest_sources = deque(self.peers)
+        self._lock = threading.RLock()
+        self._file = None
+
+    # Setup
+
+    def start(self):
+        with self._lock:
+            self._request_manifest()
+        self.network.transport.call_later(Config.SWARM_STALL_TIMEOUT, self._check_stalls)
+
+    def _request_manifest(self):
+        while self._manifest_sources:
+            source = self._manifest_sources.popleft()
+            transfer_id = uuid.uuid4().hex
+            self.active[transfer_id] = {'source': source, 'piece': None, 'started': time.monotonic(),
+                                        'last_progress': time.monotonic()}
+            try:
+                self._send(transfer_id, source, {
+                    'type': 'file_manifest_request',
+                    'transfer_id': transfer_id,
+                    'file_id': source[2],
+                    'piece_size': self.piece_size,
+                    'ttl': 0
+                })
+            except Exception as e:
+                print(f"Swarm {self.filename}: manifest request to {source[0]}:{source[1]} failed: {e}")
+                self._abandon(transfer_id, fatal=True)
+                continue
+            return
+        self._fail("no peer returned a manifest")
+
+    def on_manifest(self, transfer_id: str, message: Dict):
+        with self._lock:
+            entry = self.active.pop(transfer_id, None)
+            self.network.remove_transfer(transfer_id)
+            if entry is None or self.piece_hashes is not None or self.finished:
+                return
+            if message.get('piece_size') != self.piece_size or not isinstance(message.get('hashes'), list):
+                self._peer_failed(entry['source'], fatal=True)
+                self._request_manifest()
+                return
+            self.size = int(message['size'])
+            self.piece_hashes = message['hashes']
+
+            self.path.touch(exist_ok=True)
+            self._file = open(self.path, 'r+b')
+            self._file.truncate(self.size)
+            for index in range(len(self.piece_hashes)):
+                if self._verify_existing(index):
+                    self.done.add(index)
+                else:
+                    self.pending.append(index)
+            print(f"Swarm {self.filename}: {len(self.piece_hashes)} pieces, "
+                  f"{len(self.done)} already on disk, {len(self.peers)} sources")
+            self._schedule()
+
+    def _verify_existing(self, index: int) -> bool:
+        self._file.seek(index * self.piece_size)
+        data = self._file.read(self._piece_length(index))
+        return len(data) == self._piece_length(index) and hashlib.sha256(data).hexdigest() == self.piece_hashes[index]
+
+    def _piece_length(self, index: int) -> int:
+        return min(self.piece_size, self.size - index * self.piece_size)
+
+    # Scheduling
+
+    def _usable_peers(self):
+        return [source for source, peer in self.peers.items()
+                if peer['failures'] < Config.SWARM_MAX_PEER_FAILURES]
+
+    def _schedule(self):
+        """Give the next pending pieces to idle peers, fastest first (unmeasured peers get tried first)"""
+        if self.finished or self.piece_hashes is None:
+            return
+        if len(self.done) == len(self.piece_hashes):
+            self._complete()
+            return
+        idle = [source for source in self._usable_peers() if self.peers[source]['busy'] is None]
+        idle.sort(key=lambda source: -(self.peers[source]['rate'] or math.inf))
+        for source in idle:
+            if not self.pending:
+                break
+            self._request_piece(source, self.pending.popleft())
+        if not self.active and not self._usable_peers():
+            self._fail("every source failed")
+
+    def _request_piece(self, source: Tuple, index: int):
+        transfer_id = uuid.uuid4().hex
+        now = time.monotonic()
+        self.active[transfer_id] = {'source': source, 'piece': index, 'buffer': bytearray(),
+                                    'started': now, 'last_progress': now}
+        self.peers[source]['busy'] = transfer_id
+        try:
+            self._send(transfer_id, source, {
+                'type': 'file_request',
+                'id': f"request_{transfer_id}",
+                'transfer_id': transfer_id,
+                'filename': self.filename,
+                'file_id': source[2],
+                'offset': index * self.piece_size,
+                'length': self._piece_length(index),
+                'ttl': 0
+            })
+        except Exception as e:
+            print(f"Swarm {self.filename}: request to {source[0]}:{source[1]} failed: {e}")
+            self._abandon(transfer_id, fatal=True)
+
+    def _send(self, transfer_id: str, source: Tuple, message: Dict):
+        """Register transfer_id on the connection to source, then send message on it.
+
+        Registering first lets a fast reply find its transfer, and recording
+        the connection lets peer_disconnected fail the request the moment
+        that connection drops instead of waiting for the stall timer.
+        """
+        connection = self.network.get_connection(source[0], source[1])
+        self.network.add_transfer(transfer_id, {'swarm': self, 'filename': self.filename, 'connection': connection})
+        connection.sendall(encode_message(message))
+
+    def _peer_failed(self, source: Tuple, fatal: bool = False):
+        peer = self.peers[source]
+        peer['failures'] = Config.SWARM_MAX_PEER_FAILURES if fatal else peer['failures'] + 1
+        peer['busy'] = None
+
+    def _abandon(self, transfer_id: str, fatal: bool = False):
+        """Drop an in-flight piece, put it back at the front of the queue and penalise its peer"""
+        entry = self.active.pop(transfer_id, None)
+        self.network.remove_transfer(transfer_id)
+        if entry is None:
+            return
+        if entry['piece'] is not None:
+            self.pending.appendleft(entry['piece'])
+        self._peer_failed(entry['source'], fatal)
+
+    def _check_stalls(self):
+        try:
+            with self._lock:
+                if self.finished:
+                    return
+                cutoff = time.monotonic() - Config.SWARM_STALL_TIMEOUT
+                stalled = [transfer_id for transfer_id, entry in self.active.items()
+                           if entry['last_progress'] < cutoff]
+                for transfer_id in stalled:
+                    entry = self.active[transfer_id]
+                    print(f"Swarm {self.filename}: {entry['source'][0]}:{entry['source'][1]} stalled, reassigning")
+                    self._abandon(transfer_id)
+                    if entry['piece'] is None:
+                        self._request_manifest()
+                self._schedule()
+            if not self.finished:
+                self.network.transport.call_later(Config.SWARM_STALL_TIMEOUT / 2, self._check_stalls)
+        except Exception as e:
+            print(f"Swarm {self.filename}: error checking stalls: {e}")
+
+    # Piece data (called from P2PFloodNetwork handlers)
+
+    def on_chunk(self, transfer_id: str, message: Dict):
+        data = message['data']
+        intact = hashlib.sha256(data).hexdigest() == message.get('sha256')
+        with self._lock:
+            entry = self.active.get(transfer_id)
+            if entry is None or entry['piece'] is None:
+                return
+            expected_offset = entry['piece'] * self.piece_size + len(entry['buffer'])
+            if message.get('offset') != expected_offset or not intact:
+                self._abandon(transfer_id, fatal=True)
+                self._schedule()
+                return
+            entry['buffer'] += data
+            entry['last_progress'] = time.monotonic()
+
+    def on_piece_end(self, transfer_id: str, message: Dict):
+        with self._lock:
+            entry = self.active.get(transfer_id)
+            if entry is None or entry['piece'] is None:
+                return
+            index = entry['piece']
+            data = bytes(entry['buffer'])
+            if len(data) != self._piece_length(index) or hashlib.sha256(data).hexdigest() != self.piece_hashes[index]:
+                print(f"Swarm {self.filename}: piece {index} from {entry['source'][0]}:{entry['source'][1]} failed verification")
+                self._abandon(transfer_id, fatal=True)
+                self._schedule()
+                return
+
+            self.active.pop(transfer_id)
+            self.network.remove_transfer(transfer_id)
+            self._file.seek(index * self.piece_size)
+            self._file.write(data)
+            self.done.add(index)
+
+            # Exponentially weighted throughput drives the fastest-peer ordering
+            peer = self.peers[entry['source']]
+            rate = len(data) / max(time.monotonic() - entry['started'], 1e-3)
+            peer['rate'] = rate if peer['rate'] is None else 0.7 * peer['rate'] + 0.3 * rate
+            peer['busy'] = None
+            self._schedule()
+
+    def on_peer_lost(self, transfer_id: str):
+        with self._lock:
+            entry = self.active.get(transfer_id)
+            self._abandon(transfer_id, fatal=True)
+            if entry is not None and entry['piece'] is None:
+                self._request_manifest()
+            self._schedule()
+
+    # Outcome
+
+    def _close(self):
+        self.finished = True
+        for transfer_id in list(self.active):
+            self.network.remove_transfer(transfer_id)
+        self.active.clear()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _complete(self):
+        self._close()
+        os.replace(self.path, Path(self.network.temp_directory) / self.filename)
+        print(f"Swarm {self.filename}: complete from {len(self._usable_peers())} peers")
+        self.network.swarm_finished(self)
+
+        from app import socketio
+        socketio.emit('download_ready', {
+            'url': f'/download_temp/{self.filename}'
+        })
+
+    def _fail(self, reason: str):
+        if self.finished:
+            return
+        self._close()
+        print(f"Swarm {self.filename}: {reason}")
+        self.network.swarm_finished(self)
+
+        from app import socketio
+        socketio.emit('download_error', {
+            'error': f"Download of {self.filename} failed: {reason}"
+        })
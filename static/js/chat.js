@@ -4,6 +4,8 @@ if (!socket) {
 }
 
 var currentChatFriendId = null;
+var chatHistoryCursor = null;
+var loadingOlderMessages = false;
 
 if (typeof currentUserId == 'undefined'){
     console.error('currentUserId is not defined. Make sure it is set in HTML before the script loads!');
@@ -15,6 +17,16 @@ document.addEventListener('DOMContentLoaded', function() {
     if (clearChatButton) {
         clearChatButton.addEventListener('click', clearChat);
     }
+
+    // Fetch older pages of history when the user scrolls to the top
+    const messageArea = document.getElementById('messageArea');
+    if (messageArea) {
+        messageArea.addEventListener('scroll', () => {
+            if (messageArea.scrollTop < 50) {
+                loadOlderChatHistory();
+            }
+        });
+    }
 });
 
 // Add this function to your chat.js file
@@ -88,24 +100,15 @@ function shareFile(file) {
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            // Create message content with proper file link
-            const message = `Shared file: [Download](${data.file_link})`;
-            
-            // Send the message using the existing sendMessage function
-            sendMessage(currentChatFriendId, message);
-            
-            // Update upload status
-            updateUploadStatus('Upload complete!', 100, {
+            // The server encrypts and uploads in the background; follow the task
+            pendingUploads[data.task_id] = { uploadId: uploadId, friendId: currentChatFriendId };
+            updateUploadStatus('Uploading to IPFS...', 0, {
                 steps: [
                     { id: 'prepare', label: 'File prepared', status: 'complete' },
-                    { id: 'ipfs', label: 'IPFS Upload complete', status: 'complete' }
+                    { id: 'ipfs', label: 'IPFS Upload', status: 'current' }
                 ]
             }, uploadId);
-            
-            // Remove status after delay
-            setTimeout(() => {
-                removeUploadStatus(uploadId);
-            }, 3000);
+            checkUploadStatus(data.task_id, uploadId);
         } else {
             throw new Error(data.error || 'Upload failed');
         }
@@ -116,39 +119,73 @@ function shareFile(file) {
     });
 }
 
+// Background uploads in flight: server task_id -> local status id and target chat
+const pendingUploads = {};
+
+function showUploadProgress(taskId, progress) {
+    const pending = pendingUploads[taskId];
+    if (!pending) return;
+    updateUploadStatus(`Uploading to IPFS... ${progress}%`, progress, {
+        steps: [
+            { id: 'prepare', label: 'File prepared', status: 'complete' },
+            { id: 'ipfs', label: 'IPFS Upload', status: 'current' }
+        ]
+    }, pending.uploadId);
+}
+
+// Completion can arrive by socket event or by polling; only the first one counts
+function finishUpload(taskId, fileLink) {
+    const pending = pendingUploads[taskId];
+    if (!pending) return;
+    delete pendingUploads[taskId];
+    const uploadId = pending.uploadId;
+
+    // Send the file message to the chat the upload was started from
+    const fileMessage = `Shared file: [Download](${fileLink})`;
+    sendMessage(pending.friendId, fileMessage);
+
+    updateUploadStatus('Upload complete!', 100, {
+        steps: [
+            { id: 'prepare', label: 'File prepared', status: 'complete' },
+            { id: 'ipfs', label: 'IPFS Upload complete', status: 'complete' }
+        ]
+    }, uploadId);
+
+    // Remove status after delay
+    setTimeout(() => {
+        removeUploadStatus(uploadId);
+    }, 3000);
+}
+
+function failUpload(taskId, error) {
+    const pending = pendingUploads[taskId];
+    if (!pending) return;
+    delete pendingUploads[taskId];
+    handleUploadError(error || 'Upload failed', pending.uploadId);
+}
+
 // Add new function to check upload status
 function checkUploadStatus(taskId, uploadId) {
     const checkStatus = () => {
+        if (!pendingUploads[taskId]) return;
         fetch(`/api/upload_status/${taskId}`)
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'completed' && data.file_link) {
-                    // Create file message and send it
-                    const fileMessage = `Shared file: [Download](${data.file_link})`;
-                    sendMessage(currentChatFriendId, fileMessage);
-                    
-                    // Update upload status UI
-                    updateUploadStatus('Upload complete!', 100, {
-                        steps: [
-                            { id: 'prepare', label: 'File prepared', status: 'complete' },
-                            { id: 'ipfs', label: 'IPFS Upload complete', status: 'complete' }
-                        ]
-                    }, uploadId);
-
-                    // Remove status after delay
-                    setTimeout(() => {
-                        removeUploadStatus(uploadId);
-                    }, 3000);
-                } else if (data.status === 'error') {
-                    handleUploadError(data.error || 'Upload failed', uploadId);
+                    finishUpload(taskId, data.file_link);
+                } else if (['error', 'expired', 'unknown'].includes(data.status)) {
+                    failUpload(taskId, data.error);
                 } else {
+                    if (typeof data.progress === 'number') {
+                        showUploadProgress(taskId, data.progress);
+                    }
                     // Continue polling
                     setTimeout(checkStatus, 1000);
                 }
             })
             .catch(error => {
                 console.error('Error checking upload status:', error);
-                handleUploadError('Failed to check upload status', uploadId);
+                failUpload(taskId, 'Failed to check upload status');
             });
     };
 
@@ -423,11 +460,13 @@ function loadChatHistory(friendId) {
     
     // Set current chat friend ID
     currentChatFriendId = Number(friendId);
+    chatHistoryCursor = null;
     console.log('Set currentChatFriendId to:', currentChatFriendId);
     
     fetch(`/api/chat_history/${friendId}`)
         .then(response => response.json())
         .then(data => {
+            chatHistoryCursor = data.next_cursor ?? null;
             if (data.messages && Array.isArray(data.messages)) {
                 data.messages.forEach(msg => {
                     if (msg && msg.sender_id !== undefined && msg.content !== undefined) {
@@ -446,6 +485,48 @@ function loadChatHistory(friendId) {
         });
 }
 
+// Prepend the next older page of history, keeping the current scroll position
+function loadOlderChatHistory() {
+    if (chatHistoryCursor === null || loadingOlderMessages || currentChatFriendId === null) {
+        return;
+    }
+    loadingOlderMessages = true;
+    const friendId = currentChatFriendId;
+
+    fetch(`/api/chat_history/${friendId}?before=${chatHistoryCursor}`)
+        .then(response => response.json())
+        .then(data => {
+            if (friendId !== currentChatFriendId || !Array.isArray(data.messages)) {
+                return;
+            }
+            chatHistoryCursor = data.next_cursor ?? null;
+
+            const messageArea = document.getElementById('messageArea');
+            const previousHeight = messageArea.scrollHeight;
+            const existing = Array.from(messageArea.childNodes);
+            existing.forEach(node => node.remove());
+
+            data.messages.forEach(msg => {
+                if (msg && msg.sender_id !== undefined && msg.content !== undefined) {
+                    addMessageToChat(
+                        msg.sender_id,
+                        msg.content,
+                        msg.timestamp || new Date().toISOString()
+                    );
+                }
+            });
+
+            existing.forEach(node => messageArea.appendChild(node));
+            messageArea.scrollTop = messageArea.scrollHeight - previousHeight;
+        })
+        .catch(error => {
+            console.error('Error loading older chat history:', error);
+        })
+        .finally(() => {
+            loadingOlderMessages = false;
+        });
+}
+
 function getFileIcon(fileName) {
     // Get file extension
     const ext = fileName.split('.').pop().toLowerCase();
@@ -734,26 +815,16 @@ socket.on('user_stop_typing', (data) => {
 });
 
 // Add Socket.IO listeners for upload events
-socket.on('upload_complete', (data) => {
-    updateUploadStatus('Upload complete!', 100, {
-        steps: [
-            { id: 'prepare', label: 'File prepared', status: 'complete' },
-            { id: 'ipfs', label: 'IPFS Upload complete', status: 'complete' }
-        ]
-    }, data.uploadId);
-
-    // Add the file message to chat
-    const message = `Shared file: [Download](${data.file_link})`;
-    sendMessage(currentChatFriendId, message);
+socket.on('upload_progress', (data) => {
+    showUploadProgress(data.uploadId, data.progress);
+});
 
-    // Clean up the upload status after a delay
-    setTimeout(() => {
-        removeUploadStatus(data.uploadId);
-    }, 3000);
+socket.on('upload_complete', (data) => {
+    finishUpload(data.uploadId, data.file_link);
 });
 
 socket.on('upload_error', (data) => {
-    handleUploadError(data.error, data.uploadId);
+    failUpload(data.uploadId, data.error);
 });
 
 // Update the message display function to handle file messages
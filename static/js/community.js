@@ -2,6 +2,8 @@
 let socket;
 let communities = [];
 let currentCommunityId = null;
+let messageHistoryCursor = null;
+let loadingOlderMessages = false;
 let messageArea;
 let messageForm;
 let messageInput;
@@ -41,6 +43,19 @@ document.addEventListener('DOMContentLoaded', () => {
         messageForm.addEventListener('submit', handleMessageSubmit);
     }
 
+    // Request older history pages when scrolled to the top
+    if (messageArea) {
+        messageArea.addEventListener('scroll', () => {
+            if (messageArea.scrollTop < 50 && messageHistoryCursor !== null && !loadingOlderMessages) {
+                loadingOlderMessages = true;
+                socket.emit('get_message_history', {
+                    community_id: currentCommunityId,
+                    before: messageHistoryCursor
+                });
+            }
+        });
+    }
+
     addMembersBtn.addEventListener('click', () => {
         addMembersModal.classList.remove('hidden');
         loadAvailableUsersForAdd();
@@ -360,8 +375,19 @@ function handleMessageSubmit(e) {
 }
 function handleMessageHistory(data) {
     if (!messageArea) return;
-    
-    messageArea.innerHTML = '';
+    if (data.community_id !== currentCommunityId) return;
+
+    messageHistoryCursor = data.next_cursor ?? null;
+    loadingOlderMessages = false;
+
+    // Older pages are prepended above what is already shown
+    const isOlderPage = data.before !== null && data.before !== undefined;
+    const previousHeight = messageArea.scrollHeight;
+    const existing = isOlderPage ? Array.from(messageArea.childNodes) : [];
+    existing.forEach(node => node.remove());
+    if (!isOlderPage) {
+        messageArea.innerHTML = '';
+    }
     
     if (data.messages && Array.isArray(data.messages)) {
         data.messages.forEach(msg => {
@@ -371,6 +397,11 @@ function handleMessageHistory(data) {
             });
         });
     }
+
+    if (isOlderPage) {
+        existing.forEach(node => messageArea.appendChild(node));
+        messageArea.scrollTop = messageArea.scrollHeight - previousHeight;
+    }
 }
 
 function handleClearChat(data) {
@@ -418,6 +449,7 @@ function updateCommunityStats(data) {
 
 function joinCommunity(communityId) {
     currentCommunityId = communityId;
+    messageHistoryCursor = null;
     
     if (messageArea) {
         messageArea.innerHTML = '';
@@ -214,6 +214,14 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Bucket saves are coalesced server-side; show the hash once it is published
+    socket.on('bucket_updated', (data) => {
+        if (data.user_id && data.user_id.toString() === currentUserId && data.bucket_hash) {
+            currentBucketHash = data.bucket_hash;
+            document.getElementById('bucketHash').textContent = data.bucket_hash;
+        }
+    });
+
     socket.on('chat_history_cleared', (data) => {
         if (data.success) {
             if (data.bucket_hash) {
@@ -0,0 +1,35 @@
+import struct
+
+import pytest
+
+from python_scripts.public_chat.flood_framing import (
+    FRAME_BINARY, FRAME_HEADER, FrameDecoder, FrameError, encode_binary, encode_message
+)
+
+
+def _binary_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload) + 1, FRAME_BINARY) + payload
+
+
+def test_round_trip_split_across_chunks():
+    data = encode_message({'type': 'search', 'query': 'cat'}) + encode_binary({'type': 'file_chunk'}, b'\x00\x01')
+    decoder = FrameDecoder()
+    messages = []
+    for i in range(len(data)):
+        messages += decoder.feed(data[i:i + 1])
+    assert messages == [{'type': 'search', 'query': 'cat'}, {'type': 'file_chunk', 'data': b'\x00\x01'}]
+
+
+def test_truncated_binary_frame_raises_frame_error():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(_binary_frame(b'\x00\x00'))
+
+
+def test_binary_header_past_end_raises_frame_error():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(_binary_frame(struct.pack('>I', 100) + b'{}'))
+
+
+def test_binary_header_not_json_raises_frame_error():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(_binary_frame(struct.pack('>I', 3) + b'\xff\xfe\xfd'))